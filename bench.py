@@ -0,0 +1,567 @@
+"""Load test / benchmark for the Priya bot.
+
+Starts local stand-ins for Telegram, OpenRouter, SerpAPI, YouTube, ElevenLabs
+and Pollinations (one aiohttp server, configurable latency, error rate and
+429 rate per upstream), imports main.py pointed at them, and pushes synthetic
+text, voice, photo and /image updates through the real handlers and update
+processor at a target rate (open loop, Poisson arrivals).
+
+    python bench.py --rate 20 --duration 30
+    python bench.py --mix text=50,voice=20,photo=20,image=10 --users 50
+    python bench.py --latency openrouter=1.5 --r429 openrouter=0.1 --name slow-llm
+
+Throughput, p50/p95/p99 latency per update kind, event-loop lag and the
+per-stage timings from main's metrics are printed and appended to
+bench_results.jsonl; the previous run with the same --name is shown next to
+the new one so regressions stand out.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BOT_TOKEN = "123456:bench"
+
+UPSTREAM_DEFAULTS = {
+    # name: (latency s, error rate, 429 rate)
+    "telegram": (0.03, 0.0, 0.0),
+    "openrouter": (0.6, 0.0, 0.0),
+    "serp": (0.4, 0.0, 0.0),
+    "youtube": (0.2, 0.0, 0.0),
+    "eleven": (0.8, 0.0, 0.0),
+    "pollinations": (1.5, 0.0, 0.0),
+}
+
+TEXT_PROMPTS = [
+    "hi bestie kaise ho",
+    "python me list comprehension samjhao",
+    "ek motivational quote do",
+    "latest news india",
+    "gold price today",
+    "what is machine learning",
+    "youtube video on react hooks",
+    "write a flask hello world",
+    "mera mood off hai",
+    "who is the president of france",
+]
+IMAGE_PROMPTS = ["cute anime girl", "sunset over mountains", "cyberpunk city", "cat astronaut"]
+
+LLM_REPLY = (
+    "Haan bestie! Yeh raha jawab. Thoda detail me samjhati hoon taaki clear ho jaye, "
+    "step by step dekhte hain aur phir example bhi dekhenge 😊"
+)
+
+
+# ================== FAKE UPSTREAMS ==================
+class Upstream:
+    def __init__(self, latency, errors, r429):
+        self.latency = latency
+        self.errors = errors
+        self.r429 = r429
+        self.calls = 0
+
+    async def gate(self):
+        """Waits the simulated latency; returns 429/500 to fail the call, else None."""
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        x = random.random()
+        if x < self.r429:
+            return 429
+        if x < self.r429 + self.errors:
+            return 500
+        return None
+
+
+class FakeServer:
+    def __init__(self, upstreams, token_delay, voice_bytes, photo_bytes):
+        self.up = upstreams
+        self.token_delay = token_delay
+        self.voice_bytes = voice_bytes
+        self.photo_bytes = photo_bytes
+        self.msg_ids = 0
+        self.runner = None
+
+    # -------- Telegram Bot API --------
+    def tg_message(self, chat_id, **extra):
+        self.msg_ids += 1
+        return {
+            "message_id": self.msg_ids,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            **extra
+        }
+
+    async def telegram(self, request):
+        status = await self.up["telegram"].gate()
+        if status == 429:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            }, status=429)
+        if status:
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                status=500
+            )
+
+        method = request.match_info["method"]
+        data = await request.post()
+        chat_id = data.get("chat_id")
+        n = self.msg_ids + 1
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Priya", "username": "priya_bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self.tg_message(chat_id, text=data.get("text", ""))
+        elif method == "sendPhoto":
+            result = self.tg_message(chat_id, photo=[
+                {"file_id": f"out-photo-{n}", "file_unique_id": f"out-photo-{n}",
+                 "width": 512, "height": 512}
+            ])
+        elif method == "sendVoice":
+            result = self.tg_message(chat_id, voice={
+                "file_id": f"out-voice-{n}", "file_unique_id": f"out-voice-{n}", "duration": 1
+            })
+        elif method == "sendDocument":
+            result = self.tg_message(chat_id, document={
+                "file_id": f"out-doc-{n}", "file_unique_id": f"out-doc-{n}"
+            })
+        elif method == "getFile":
+            file_id = data.get("file_id", "")
+            kind = file_id.split("-", 1)[0]
+            result = {
+                "file_id": file_id, "file_unique_id": file_id,
+                "file_size": len(self.voice_bytes if kind == "voice" else self.photo_bytes),
+                "file_path": f"{kind}/{file_id}"
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def telegram_file(self, request):
+        await self.up["telegram"].gate()
+        if request.match_info["path"].startswith("voice/"):
+            return web.Response(body=self.voice_bytes)
+        return web.Response(body=self.photo_bytes)
+
+    # -------- OpenRouter --------
+    async def openrouter(self, request):
+        body = await request.json()
+        status = await self.up["openrouter"].gate()
+        if status:
+            return web.json_response(
+                {"error": {"code": status}}, status=status, headers={"Retry-After": "2"}
+            )
+
+        reply = LLM_REPLY
+        last = body.get("messages", [{}])[-1]
+        if isinstance(last.get("content"), list):
+            reply = "[Image: a synthetic benchmark photo]\n" + reply
+
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": reply}}]})
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        try:
+            await resp.write(b": OPENROUTER PROCESSING\n\n")
+            for word in reply.split(" "):
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(self.token_delay)
+            await resp.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            pass  # the bot gave up on the stream (e.g. its Telegram send failed)
+        return resp
+
+    # -------- search / media --------
+    async def serp(self, request):
+        status = await self.up["serp"].gate()
+        if status:
+            return web.json_response({"error": "fake failure"}, status=status)
+        q = request.query.get("q", "")
+        return web.json_response({"organic_results": [
+            {"title": f"{q} result {i}", "snippet": "Benchmark snippet text.",
+             "link": f"https://example.com/{i}"}
+            for i in range(5)
+        ]})
+
+    async def youtube(self, request):
+        status = await self.up["youtube"].gate()
+        if status:
+            return web.json_response({"error": "fake failure"}, status=status)
+        q = request.query.get("q", "")
+        return web.json_response({"items": [
+            {"snippet": {"title": f"{q} video {i}", "channelTitle": "Bench"},
+             "id": {"videoId": f"vid{i}"}}
+            for i in range(3)
+        ]})
+
+    async def eleven(self, request):
+        await request.read()
+        status = await self.up["eleven"].gate()
+        if status:
+            return web.json_response({"detail": "fake failure"}, status=status)
+        return web.Response(body=self.voice_bytes, content_type="audio/mpeg")
+
+    async def pollinations(self, request):
+        status = await self.up["pollinations"].gate()
+        if status:
+            return web.Response(status=status)
+        return web.Response(body=self.photo_bytes, content_type="image/jpeg")
+
+    async def start(self, port):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.telegram_file)
+        app.router.add_post("/openrouter/chat/completions", self.openrouter)
+        app.router.add_get("/serp/search.json", self.serp)
+        app.router.add_get("/youtube/search", self.youtube)
+        app.router.add_post("/eleven/text-to-speech/{voice}", self.eleven)
+        app.router.add_get("/pollinations/prompt/{prompt:.*}", self.pollinations)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def sample_voice():
+    """A few seconds of tone and silence as OGG/Opus, if ffmpeg is around."""
+    if shutil.which("ffmpeg"):
+        try:
+            return subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error",
+                 "-f", "lavfi", "-i", "sine=frequency=440:duration=2",
+                 "-f", "lavfi", "-i", "anullsrc=r=48000:cl=mono:d=1",
+                 "-filter_complex", "[0][1][0]concat=n=3:v=0:a=1",
+                 "-ac", "1", "-c:a", "libopus", "-f", "ogg", "pipe:1"],
+                capture_output=True, check=True, timeout=30
+            ).stdout
+        except Exception as e:
+            print("⚠️ ffmpeg voice sample failed:", e)
+    return b"OggS" + os.urandom(8000)
+
+
+def sample_photo():
+    try:
+        from PIL import Image
+        img = Image.effect_noise((1280, 1280), 64).convert("RGB")
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=85)
+        return out.getvalue()
+    except ImportError:
+        return b"\xff\xd8\xff" + os.urandom(200_000)
+
+
+# ================== SYNTHETIC UPDATES ==================
+def make_update(kind, uid, n):
+    msg = {
+        "message_id": n,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+    }
+    if kind == "text":
+        msg["text"] = random.choice(TEXT_PROMPTS)
+    elif kind == "voice":
+        msg["voice"] = {"file_id": f"voice-{n}", "file_unique_id": f"voice-{n}", "duration": 5}
+    elif kind == "photo":
+        msg["photo"] = [
+            {"file_id": f"photo-{n}-{side}", "file_unique_id": f"photo-{n}-{side}",
+             "width": side, "height": side}
+            for side in (90, 320, 1280)
+        ]
+    elif kind == "image":
+        msg["text"] = "/image " + random.choice(IMAGE_PROMPTS)
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+    return {"update_id": n, "message": msg}
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def summarize(values):
+    return {
+        "n": len(values),
+        "p50": round(pct(values, 50), 4),
+        "p95": round(pct(values, 95), 4),
+        "p99": round(pct(values, 99), 4),
+        "max": round(max(values), 4) if values else 0.0,
+    }
+
+
+async def loop_lag(samples, interval=0.05):
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - t - interval)
+
+
+def stage_summary(hist):
+    out = {}
+    for labels, s in hist.series.items():
+        count = sum(s[:-1])
+        if count:
+            out[labels[0]] = {"n": count, "mean": round(s[-1] / count, 4)}
+    return out
+
+
+# ================== RUN ==================
+async def run(args, upstreams, log):
+    fake = FakeServer(upstreams, args.token_delay, sample_voice(), sample_photo())
+    port = free_port()
+    await fake.start(port)
+    base = f"http://127.0.0.1:{port}"
+
+    tmp = tempfile.mkdtemp(prefix="priya-bench-")
+    env = {
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_IDS": os.getenv("ADMIN_IDS", "1"),
+        "SERP_API_KEY": "bench", "YOUTUBE_API_KEY": "bench",
+        "OPENROUTER_BASE_URL": base + "/openrouter",
+        "ELEVEN_BASE_URL": base + "/eleven",
+        "SERP_BASE_URL": base + "/serp",
+        "YOUTUBE_BASE_URL": base + "/youtube",
+        "POLLINATIONS_BASE_URL": base + "/pollinations",
+        "TELEGRAM_BASE_URL": base + "/bot",
+        "TELEGRAM_FILE_URL": base + "/file/bot",
+        "DB_PATH": os.path.join(tmp, "memory.db"),
+        "TTS_CACHE_DIR": os.path.join(tmp, "tts_cache"),
+        "IMAGE_CACHE_DIR": os.path.join(tmp, "image_cache"),
+        "PORT": str(free_port()),
+        "WEBHOOK_URL": "",
+    }
+    for i in range(1, 9):
+        env[f"OPENROUTER_API_{i}"] = f"bench-or-{i}" if i <= args.keys else ""
+    for i in range(1, 4):
+        env[f"ELEVEN_API_{i}"] = f"bench-el-{i}"
+    os.environ.update(env)
+
+    sys.path.insert(0, ROOT)
+    import main
+    from telegram import Update
+
+    main.set_transcriber(main.StandInTranscriber())   # no speech API calls
+    app = main.build_app()
+    errors = {}
+
+    async def on_error(update, ctx):
+        if isinstance(update, Update):
+            errors[update.update_id] = repr(ctx.error)
+    app.add_error_handler(on_error)
+
+    await app.initialize()
+    await main.on_startup(app)
+    await app.start()
+
+    kinds, weights = zip(*args.mix.items())
+    latencies = {k: [] for k in kinds}
+    failed = {k: 0 for k in kinds}
+    lag = []
+    lag_task = asyncio.ensure_future(loop_lag(lag))
+
+    async def push(kind, n, scheduled):
+        uid = 1000 + random.randrange(args.users)
+        update = Update.de_json(make_update(kind, uid, n), app.bot)
+        await main.update_processor.process_update(update, app.process_update(update))
+        latencies[kind].append(time.perf_counter() - scheduled)
+        if n in errors:
+            failed[kind] += 1
+
+    print(f"🚀 Bench '{args.name}': {args.rate}/s for {args.duration}s, "
+          f"{args.users} users, mix {args.mix}", file=log, flush=True)
+    tasks = []
+    start = time.perf_counter()
+    at = start
+    n = 0
+    while True:
+        at += random.expovariate(args.rate)
+        if at - start >= args.duration:
+            break
+        n += 1
+        delay = at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = random.choices(kinds, weights)[0]
+        tasks.append(asyncio.ensure_future(push(kind, n, at)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    drain_deadline = time.monotonic() + 60
+    while main.media_queue.pending and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.1)
+    lag_task.cancel()
+
+    all_lat = [v for vals in latencies.values() for v in vals]
+    result = {
+        "ts": int(time.time()),
+        "name": args.name,
+        "commit": git_commit(),
+        "config": {
+            "rate": args.rate, "duration": args.duration, "users": args.users,
+            "mix": args.mix, "keys": args.keys, "token_delay": args.token_delay,
+            "upstreams": {k: [u.latency, u.errors, u.r429] for k, u in upstreams.items()},
+            "ffmpeg": bool(shutil.which("ffmpeg")),
+            "stream_replies": main.STREAM_REPLIES,
+        },
+        "updates": len(all_lat),
+        "errors": len(errors),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(all_lat) / elapsed, 3) if elapsed else 0.0,
+        "latency": {"all": summarize(all_lat), **{k: summarize(v) for k, v in latencies.items()}},
+        "failed": failed,
+        "loop_lag": summarize(lag),
+        "stages": stage_summary(main.STAGE_SECONDS),
+        "telegram": stage_summary(main.TELEGRAM_SECONDS),
+        "upstream_calls": {k: u.calls for k, u in upstreams.items()},
+    }
+
+    await app.stop()
+    await main.on_shutdown(app)
+    await app.shutdown()
+    await fake.stop()
+    shutil.rmtree(tmp, ignore_errors=True)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+def previous_run(path, name):
+    last = None
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row.get("name") == name:
+                    last = row
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def report(result, prev):
+    def delta(new, old):
+        if not old:
+            return ""
+        return f" ({100 * (new - old) / old:+.0f}%)"
+
+    old_all = prev["latency"]["all"] if prev else {}
+    print(
+        f"\n📊 {result['updates']} updates in {result['elapsed']:.1f}s → "
+        f"{result['throughput']:.2f} upd/s"
+        f"{delta(result['throughput'], prev and prev['throughput'])}, errors {result['errors']}"
+    )
+    print(f"{'kind':<8}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for kind, s in result["latency"].items():
+        print(f"{kind:<8}{s['n']:>6}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['p99']:>9.3f}{s['max']:>9.3f}")
+    if prev:
+        s = result["latency"]["all"]
+        print(
+            f"vs {prev['commit'] or 'previous'}: p50{delta(s['p50'], old_all.get('p50'))} "
+            f"p95{delta(s['p95'], old_all.get('p95'))} p99{delta(s['p99'], old_all.get('p99'))}"
+        )
+    lag = result["loop_lag"]
+    print(f"⏱ Loop lag: p50 {lag['p50'] * 1000:.1f}ms, p99 {lag['p99'] * 1000:.1f}ms, "
+          f"max {lag['max'] * 1000:.1f}ms")
+    stages = ", ".join(f"{k} {v['mean'] * 1000:.0f}ms×{v['n']}" for k, v in result["stages"].items())
+    print("🧩 Stages (mean):", stages or "-")
+
+
+def parse_pairs(values, cast=float):
+    out = {}
+    for item in values or []:
+        for pair in item.split(","):
+            name, _, value = pair.partition("=")
+            out[name.strip()] = cast(value)
+    return out
+
+
+def main_cli():
+    p = argparse.ArgumentParser(description="Priya bot load test with local upstream stand-ins")
+    p.add_argument("--name", default="default", help="scenario name, used to compare runs")
+    p.add_argument("--rate", type=float, default=10, help="updates per second (Poisson)")
+    p.add_argument("--duration", type=float, default=20, help="seconds of load")
+    p.add_argument("--users", type=int, default=100, help="distinct synthetic users")
+    p.add_argument("--mix", default="text=70,voice=10,photo=10,image=10",
+                   help="update kinds and weights")
+    p.add_argument("--keys", type=int, default=4, help="fake OpenRouter keys (1-8)")
+    p.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+    p.add_argument("--latency", action="append", help="upstream=seconds, e.g. openrouter=1.2")
+    p.add_argument("--errors", action="append", help="upstream=rate of 5xx, e.g. serp=0.05")
+    p.add_argument("--r429", action="append", help="upstream=rate of 429s, e.g. openrouter=0.1")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default=os.path.join(ROOT, "bench_results.jsonl"))
+    p.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    args = p.parse_args()
+
+    args.mix = parse_pairs([args.mix])
+    args.keys = max(1, min(8, args.keys))
+    latency, errs, r429 = parse_pairs(args.latency), parse_pairs(args.errors), parse_pairs(args.r429)
+    for table in (latency, errs, r429):
+        unknown = set(table) - set(UPSTREAM_DEFAULTS)
+        if unknown:
+            p.error(f"unknown upstream(s): {', '.join(sorted(unknown))}")
+    unknown = set(args.mix) - {"text", "voice", "photo", "image"}
+    if unknown:
+        p.error(f"unknown update kind(s): {', '.join(sorted(unknown))}")
+
+    upstreams = {
+        name: Upstream(latency.get(name, lat), errs.get(name, err), r429.get(name, rl))
+        for name, (lat, err, rl) in UPSTREAM_DEFAULTS.items()
+    }
+    random.seed(args.seed)
+
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        result = asyncio.run(run(args, upstreams, stdout))
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+    prev = previous_run(args.out, args.name)
+    report(result, prev)
+    with open(args.out, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    print("💾 Saved to", args.out)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,14 +1,28 @@
-import os, time, sqlite3, asyncio, httpx, base64, re, zipfile
+import os, time, sqlite3, asyncio, httpx, base64, re, zipfile, random, json, queue
+import concurrent.futures
+import signal
+import sys
+import contextvars
+import hashlib
+import bisect
+import contextlib
+import functools
+import multiprocessing
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from io import BytesIO
 from dotenv import load_dotenv
 from telegram import Update, InputFile
 from telegram.constants import ChatAction
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
 from gtts import gTTS
 import speech_recognition as sr
-import googleapiclient.discovery
-from flask import Flask
+from aiohttp import web
+import secrets
 import threading
+import workers
 
 # ================== ENV ==================
 load_dotenv()
@@ -23,7 +37,639 @@ ADMIN_IDS = list(
 def is_admin(uid):
     return int(uid) in ADMIN_IDS
 
+# ================== HTTP CLIENTS ==================
+# One pooled keep-alive client per upstream host, opened at startup and
+# closed on shutdown, so chat turns reuse warm TCP/TLS connections.
+try:
+    import h2  # noqa: F401  (httpx[http2])
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP2_ENABLED = os.getenv("HTTP2", "1") == "1" and HTTP2_AVAILABLE
+
+UPSTREAMS = {
+    # name: (read timeout s, max connections, http2)
+    "openrouter": (60, 64, True),
+    "eleven": (40, 16, True),
+    "serp": (30, 16, True),
+    "youtube": (10, 16, True),
+    "pollinations": (60, 16, False),
+}
+
+# Base URLs can be overridden (bench.py points them at local stand-ins)
+UPSTREAM_URLS = {
+    "openrouter": os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
+    "eleven": os.getenv("ELEVEN_BASE_URL", "https://api.elevenlabs.io/v1"),
+    "serp": os.getenv("SERP_BASE_URL", "https://serpapi.com"),
+    "youtube": os.getenv("YOUTUBE_BASE_URL", "https://www.googleapis.com/youtube/v3"),
+    "pollinations": os.getenv("POLLINATIONS_BASE_URL", "https://image.pollinations.ai"),
+}
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+HTTP_CLIENTS = {}
+
+def http_client(name):
+    client = HTTP_CLIENTS.get(name)
+    if client is None or client.is_closed:
+        read_timeout, max_conn, use_h2 = UPSTREAMS[name]
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=10),
+            limits=httpx.Limits(
+                max_connections=max_conn,
+                max_keepalive_connections=max_conn,
+                keepalive_expiry=90
+            ),
+            http2=HTTP2_ENABLED and use_h2
+        )
+        HTTP_CLIENTS[name] = client
+    return client
+
+async def open_http_clients():
+    for name in UPSTREAMS:
+        http_client(name)
+
+async def close_http_clients():
+    for client in HTTP_CLIENTS.values():
+        try:
+            await client.aclose()
+        except Exception as e:
+            print("HTTP close error:", e)
+    HTTP_CLIENTS.clear()
+
+# ================== METRICS ==================
+# In-process Prometheus metrics, served in text format at /metrics by the web
+# server. Stage latencies are histograms fed by timed()/stage_timer(); queue
+# depths, cache hits and key failovers are read from the live objects at
+# scrape time by the COLLECTORS functions, so hot paths only pay for one
+# histogram observe.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS = []
+COLLECTORS = []
+
+def _label_str(pairs):
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + body + "}" if body else ""
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}       # label values -> count
+        METRICS.append(self)
+
+    def inc(self, *label_values, n=1):
+        self.values[label_values] = self.values.get(label_values, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for lv, v in self.values.items():
+            yield f"{self.name}{_label_str(zip(self.labels, lv))} {v}"
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}       # label values -> [count per bucket..., +Inf, sum]
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        s = self.series.get(label_values)
+        if s is None:
+            s = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for lv, s in self.series.items():
+            pairs = list(zip(self.labels, lv))
+            total = 0
+            for b, n in zip(self.buckets + ("+Inf",), s):
+                total += n
+                yield f"{self.name}_bucket{_label_str(pairs + [('le', b)])} {total}"
+            yield f"{self.name}_sum{_label_str(pairs)} {s[-1]}"
+            yield f"{self.name}_count{_label_str(pairs)} {total}"
+
+def collector(fn):
+    """Registers fn() -> [(name, type, help, {label: value}, value), ...]."""
+    COLLECTORS.append(fn)
+    return fn
+
+def metrics_text():
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    # rows are grouped by name: a family's samples must be contiguous,
+    # whichever collector (or position in it) they come from
+    families = {}   # name -> [HELP, TYPE, samples...], first-seen order
+    for collect in COLLECTORS:
+        try:
+            rows = list(collect())
+        except Exception as e:
+            print("Metrics collector error:", e)
+            continue
+        for name, kind, help, labels, value in rows:
+            family = families.get(name)
+            if family is None:
+                family = families[name] = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            family.append(f"{name}{_label_str(labels.items())} {value}")
+    for family in families.values():
+        lines.extend(family)
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram(
+    "priya_stage_seconds", "Latency of one pipeline stage.", ("stage",)
+)
+KEY_SECONDS = Histogram(
+    "priya_key_request_seconds", "Upstream request latency per API key.",
+    ("pool", "key", "outcome")
+)
+TELEGRAM_SECONDS = Histogram(
+    "priya_telegram_seconds", "Telegram Bot API call latency.", ("method",)
+)
+UPDATE_SECONDS = Histogram(
+    "priya_update_seconds", "Time to process one update, user lock wait included.",
+    ("handler",)
+)
+UPDATES_TOTAL = Counter(
+    "priya_updates_total", "Updates received, by handler.", ("handler",)
+)
 
+@contextlib.contextmanager
+def stage_timer(stage):
+    t0 = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage)
+
+def timed(stage):
+    """Decorator: records every call of an async function under `stage`."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def run(*args, **kwargs):
+            with stage_timer(stage):
+                return await fn(*args, **kwargs)
+        return run
+    return wrap
+
+class TelegramRequest(HTTPXRequest):
+    """Bot API transport that times every call by method (sendMessage, ...)."""
+    async def do_request(self, url, method, *args, **kwargs):
+        # file downloads (/file/bot<token>/<path>) share one label
+        api = "download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            with span("tg." + api):
+                return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - t0, api)
+
+# ================== TRACING ==================
+# Every update (and every background media job) gets a span tree: the root is
+# opened by the update processor, stage_timer()/span() add children through a
+# ContextVar, so tasks spawned inside an update report into its tree. Updates
+# slower than SLOW_UPDATE_SECONDS are logged with their tree. TRACE_UPDATES=0
+# turns it off; then span() is a ContextVar lookup and nothing else.
+TRACE_UPDATES = os.getenv("TRACE_UPDATES", "1") == "1"
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "5"))
+TRACE_MAX_SPANS = 200
+
+_current_span = contextvars.ContextVar("span", default=None)
+slow_traces = deque(maxlen=20)
+trace_stats = {"traced": 0, "slow": 0}
+
+class Span:
+    __slots__ = ("name", "start", "end", "children", "root", "count", "attrs")
+
+    def __init__(self, name, root=None, attrs=None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.root = root or self
+        self.count = 0
+        self.attrs = attrs
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def lines(self, depth=0, origin=None):
+        origin = self.start if origin is None else origin
+        yield (f"{'  ' * depth}{self.name} {self.duration * 1000:.0f}ms "
+               f"@+{(self.start - origin) * 1000:.0f}ms" + ("" if self.end else " (running)"))
+        for child in self.children:
+            yield from child.lines(depth + 1, origin)
+
+@contextlib.contextmanager
+def span(name):
+    parent = _current_span.get()
+    if parent is None or parent.root.count >= TRACE_MAX_SPANS:
+        yield
+        return
+    s = Span(name, parent.root)
+    parent.root.count += 1
+    parent.children.append(s)
+    token = _current_span.set(s)
+    try:
+        yield
+    finally:
+        s.end = time.perf_counter()
+        _current_span.reset(token)
+
+@contextlib.contextmanager
+def trace(name, **attrs):
+    """Root span for one update / job; logs the tree if it was slow."""
+    if not TRACE_UPDATES:
+        yield None
+        return
+    root = Span(name, attrs=attrs)
+    token = _current_span.set(root)
+    try:
+        yield root
+    finally:
+        root.end = time.perf_counter()
+        _current_span.reset(token)
+        trace_stats["traced"] += 1
+        if root.duration >= SLOW_UPDATE_SECONDS:
+            trace_stats["slow"] += 1
+            head = " ".join(f"{k}={v}" for k, v in attrs.items())
+            text = f"🐢 Slow {head}\n" + "\n".join(root.lines())
+            slow_traces.append((time.time(), root.duration, text))
+            print(text)
+
+def trace_stats_text():
+    line = (f"🐢 Traces: {trace_stats['traced']}, slow (>{SLOW_UPDATE_SECONDS:g}s) "
+            f"{trace_stats['slow']}")
+    if slow_traces:
+        _, dur, text = slow_traces[-1]
+        line += f", last {dur:.1f}s:\n" + "\n".join(text.splitlines()[:12])
+    return line
+
+# ================== PROFILER ==================
+# /profile <seconds>: a sampling profiler for the event-loop thread. A
+# background thread reads the loop thread's stack every PROFILE_INTERVAL
+# (sys._current_frames) and counts the functions on it; a heartbeat task on
+# the loop lets the same thread spot stalls (loop blocked > LOOP_STALL_MS)
+# and what was running during them. Nothing runs outside a profiling window.
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = 120
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "100"))
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+class ProfilerBusy(Exception):
+    pass
+
+class SamplingProfiler:
+    def __init__(self, interval, stall_ms):
+        self.interval = interval
+        self.stall = stall_ms / 1000
+        self.running = False
+
+    @staticmethod
+    def _where(key):
+        filename, line, name = key
+        return f"{os.path.basename(filename)}:{line} {name}"
+
+    def _sample(self, tid, stop):
+        in_stall = None                     # [longest lag, last busy stack]
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(tid)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            self.samples += 1
+
+            idle = os.path.basename(stack[0][0]) == "selectors.py"
+            if idle:
+                self.idle += 1              # loop waiting for I/O
+            else:
+                self.self_counts[stack[0]] = self.self_counts.get(stack[0], 0) + 1
+                for key in set(stack):
+                    # the loop machinery is on every stack; it would top the list
+                    if key[2] == "<module>" or key[0].startswith(_ASYNCIO_DIR):
+                        continue
+                    self.total_counts[key] = self.total_counts.get(key, 0) + 1
+
+            lag = time.monotonic() - self.beat
+            if lag > self.stall:
+                if in_stall is None:
+                    in_stall = [lag, None]
+                in_stall[0] = max(in_stall[0], lag)
+                if not idle:
+                    in_stall[1] = stack
+            elif in_stall is not None:
+                self.stalls.append(in_stall)
+                in_stall = None
+        if in_stall is not None:
+            self.stalls.append(in_stall)
+
+    def _culprit(self, stack):
+        """Innermost frame from this project's code, else the innermost frame."""
+        if not stack:
+            return "?"
+        here = os.path.dirname(os.path.abspath(__file__))
+        for key in stack:
+            if os.path.dirname(os.path.abspath(key[0])) == here:
+                return self._where(key)
+        return self._where(stack[0])
+
+    async def run(self, seconds):
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        self.samples = self.idle = 0
+        self.self_counts, self.total_counts, self.stalls = {}, {}, []
+        self.beat = time.monotonic()
+
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample, args=(threading.get_ident(), stop),
+            name="profiler", daemon=True
+        )
+        sampler.start()
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self.beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self.running = False
+        return self.report(seconds)
+
+    def report(self, seconds, top=10):
+        n = max(1, self.samples)
+        busy = self.samples - self.idle
+        lines = [f"🔬 Profile {seconds:g}s: {self.samples} samples, loop busy {100 * busy / n:.1f}%"]
+        if busy:
+            lines.append("🔥 Hottest (self):")
+            hot = sorted(self.self_counts.items(), key=lambda kv: -kv[1])[:top]
+            for i, (key, c) in enumerate(hot, start=1):
+                lines.append(f"{i}. {self._where(key)} {100 * c / n:.1f}%")
+            lines.append("📚 Hottest (incl. callees):")
+            hot = sorted(self.total_counts.items(), key=lambda kv: -kv[1])[:top]
+            for i, (key, c) in enumerate(hot, start=1):
+                lines.append(f"{i}. {self._where(key)} {100 * c / n:.1f}%")
+        if self.stalls:
+            worst = sorted(self.stalls, key=lambda st: -st[0])[:5]
+            lines.append(f"🥵 Loop stalls >{self.stall * 1000:.0f}ms: {len(self.stalls)}")
+            for lag, stack in worst:
+                lines.append(f"- {lag * 1000:.0f}ms in {self._culprit(stack)}")
+        else:
+            lines.append(f"✅ No loop stalls >{self.stall * 1000:.0f}ms")
+        return "\n".join(lines)
+
+profiler = SamplingProfiler(PROFILE_INTERVAL, LOOP_STALL_MS)
+
+
+# ================== EXECUTION POOLS ==================
+# Blocking SDK calls run on a bounded thread pool, CPU-heavy audio work on a
+# process pool. Each pool caps its queue depth (PoolBusy when full) and every
+# task gets a timeout so one slow call never stalls the event loop. A task
+# that timed out keeps its thread/process busy until it really ends, so it
+# keeps its place in the queue until then.
+IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+IO_QUEUE_LIMIT = int(os.getenv("IO_QUEUE_LIMIT", "200"))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 2)))
+CPU_QUEUE_LIMIT = int(os.getenv("CPU_QUEUE_LIMIT", "50"))
+
+GTTS_TIMEOUT = 20
+STT_TIMEOUT = 30
+TRANSCODE_TIMEOUT = 30
+
+class PoolBusy(Exception):
+    pass
+
+class TaskPool:
+    def __init__(self, name, make_executor, limit):
+        self.name = name
+        self.make_executor = make_executor
+        self.limit = limit
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def start(self):
+        if self.executor is None:
+            self.executor = self.make_executor()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args, timeout=None):
+        if self.pending >= self.limit:
+            self.rejected += 1
+            raise PoolBusy(f"{self.name} pool full ({self.pending})")
+        self.start()
+        loop = asyncio.get_running_loop()
+        cfut = self.executor.submit(fn, *args)
+        self.pending += 1
+
+        def release(_):
+            # from the worker thread, once the task has actually finished
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:
+                pass   # loop already closed
+
+        cfut.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(cfut), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def _release(self):
+        self.pending -= 1
+
+    def stats_text(self):
+        return (
+            f"⚙️ {self.name} pool: pending {self.pending}/{self.limit}, "
+            f"rejected {self.rejected}, timeouts {self.timeouts}"
+        )
+
+IO_POOL = TaskPool(
+    "io",
+    lambda: concurrent.futures.ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="io"),
+    IO_QUEUE_LIMIT
+)
+CPU_POOL = TaskPool(
+    "cpu",
+    lambda: concurrent.futures.ProcessPoolExecutor(
+        CPU_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    ),
+    CPU_QUEUE_LIMIT
+)
+
+# ================== TRANSCODE ==================
+# Streams audio through an ffmpeg subprocess into Opus-in-OGG (Telegram's
+# native voice format) while it is still downloading; no PCM copy is kept.
+TRANSCODE_MAX = int(os.getenv("TRANSCODE_MAX", "4"))
+_transcode_slots = asyncio.Semaphore(TRANSCODE_MAX)
+
+class TranscodeError(Exception):
+    """Local failure (ffmpeg missing, crashed or timed out); errors from the
+    input stream itself propagate unchanged."""
+
+@timed("transcode")
+async def transcode_stream_to_ogg(chunks):
+    async with _transcode_slots:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0", "-vn", "-ac", "1",
+                "-c:a", "libopus", "-b:a", "48k", "-f", "ogg", "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            raise TranscodeError(f"ffmpeg spawn failed: {e}") from e
+
+        async def feed():
+            try:
+                async for chunk in chunks:
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+            except ConnectionError:
+                pass   # ffmpeg exited early; its exit status says why
+            finally:
+                proc.stdin.close()
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            out, err = await asyncio.wait_for(
+                asyncio.gather(proc.stdout.read(), proc.stderr.read()),
+                TRANSCODE_TIMEOUT
+            )
+            await feeder
+            await proc.wait()
+        except BaseException as e:
+            feeder.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                raise TranscodeError(f"ffmpeg timed out after {TRANSCODE_TIMEOUT}s") from e
+            raise
+
+        if proc.returncode != 0 or not out:
+            raise TranscodeError(err.decode(errors="ignore")[:200])
+        return out
+
+# ================== KEY SCHEDULER ==================
+# Health-aware API key pool: spreads load over healthy keys, puts failing
+# keys in an exponential cooldown and skips them until it expires.
+class KeyPool:
+    def __init__(self, name, keys, base_cooldown=5, max_cooldown=600):
+        self.name = name
+        self.keys = list(keys)
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.failovers = 0
+        self.labels = {k: str(i) for i, k in enumerate(self.keys, start=1)}
+        self.state = {
+            k: {
+                "ewma": 1.0, "inflight": 0, "fails": 0, "cooldown_until": 0.0,
+                "ok": 0, "r429": 0, "r5xx": 0, "errors": 0, "dead": 0
+            }
+            for k in self.keys
+        }
+
+    def order(self):
+        """Keys that are not cooling down, least loaded / fastest first."""
+        now = time.monotonic()
+        ready = [k for k in self.keys if self.state[k]["cooldown_until"] <= now]
+        random.shuffle(ready)
+        return sorted(
+            ready,
+            key=lambda k: self.state[k]["ewma"] * (1 + self.state[k]["inflight"])
+        )
+
+    def start(self, key):
+        self.state[key]["inflight"] += 1
+        return time.monotonic()
+
+    def release(self, key):
+        """Attempt abandoned (cancelled) without a verdict on the key."""
+        self.state[key]["inflight"] -= 1
+
+    def success(self, key, t0):
+        st = self.state[key]
+        st["inflight"] -= 1
+        KEY_SECONDS.observe(time.monotonic() - t0, self.name, self.labels[key], "ok")
+        st["ewma"] = 0.8 * st["ewma"] + 0.2 * (time.monotonic() - t0)
+        st["fails"] = 0
+        st["ok"] += 1
+
+    def failure(self, key, t0, status=None, retry_after=None):
+        st = self.state[key]
+        st["inflight"] -= 1
+        KEY_SECONDS.observe(time.monotonic() - t0, self.name, self.labels[key], "fail")
+        st["ewma"] = 0.8 * st["ewma"] + 0.2 * (time.monotonic() - t0)
+        self.failovers += 1
+
+        if status is not None and 400 <= status < 500 and status not in (401, 402, 403, 429):
+            # bad request, not a bad key
+            st["errors"] += 1
+            return
+
+        st["fails"] += 1
+        cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** (st["fails"] - 1))
+        if status == 429:
+            st["r429"] += 1
+            if retry_after:
+                cooldown = min(self.max_cooldown, max(cooldown, retry_after))
+        elif status in (401, 402, 403):
+            st["dead"] += 1
+            cooldown = self.max_cooldown
+        elif status is not None and status >= 500:
+            st["r5xx"] += 1
+        else:
+            st["errors"] += 1
+        st["cooldown_until"] = time.monotonic() + cooldown
+
+    def stats_text(self):
+        now = time.monotonic()
+        lines = [f"🔑 {self.name} keys (failovers: {self.failovers})"]
+        for i, k in enumerate(self.keys, start=1):
+            st = self.state[k]
+            wait = max(0, int(st["cooldown_until"] - now))
+            status = f"⏸ {wait}s" if wait else "✅"
+            lines.append(
+                f"{i}. {k[:8]}**** {status} ok={st['ok']} 429={st['r429']} "
+                f"5xx={st['r5xx']} err={st['errors']} dead={st['dead']} "
+                f"lat={st['ewma']:.2f}s"
+            )
+        return "\n".join(lines)
+
+def retry_after_seconds(r):
+    try:
+        return float(r.headers.get("retry-after", ""))
+    except ValueError:
+        return None
 
 # ================== MULTI API KEYS ==================
 OPENROUTER_KEYS = [
@@ -44,13 +690,16 @@ ELEVEN_KEYS = [
     os.getenv("ELEVEN_API_3")
 ]
 ELEVEN_KEYS = [k for k in ELEVEN_KEYS if k]
+ELEVEN_POOL = KeyPool("ElevenLabs", ELEVEN_KEYS)
 
 ELEVEN_VOICES = {
     "priya": "EXAVITQu4vr4xnSDxMaL",
     "rose": "VR6AewLTigWG4xSOukaG"
 }
 
+@timed("eleven")
 async def eleven_tts(text, voice_name="priya"):
+    """Returns the reply as OGG/Opus bytes, transcoded while it streams in."""
     if not ELEVEN_KEYS:
         print("❌ No ElevenLabs keys found")
         return None
@@ -58,7 +707,8 @@ async def eleven_tts(text, voice_name="priya"):
     voice_id = ELEVEN_VOICES.get(voice_name, ELEVEN_VOICES["priya"])
     clean = re.sub(r"```.*?```", "Code attached.", text, flags=re.DOTALL)[:800]
 
-    for api_key in ELEVEN_KEYS:
+    for api_key in ELEVEN_POOL.order():
+        t0 = ELEVEN_POOL.start(api_key)
         try:
             headers = {
                 "xi-api-key": api_key,
@@ -75,36 +725,56 @@ async def eleven_tts(text, voice_name="priya"):
                 }
             }
 
-            async with httpx.AsyncClient(timeout=40) as client:
-                r = await client.post(
-                    f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}",
-                    headers=headers,
-                    json=payload
-                )
-
-            print("🎤 ElevenLabs status:", r.status_code)
-
-            if r.status_code == 200:
-                bio = BytesIO(r.content)
-                bio.seek(0)
-                print("🎤 ElevenLabs voice used")
-                return bio
-            else:
-                print("❌ ElevenLabs error:", r.status_code, r.text[:200])
+            async with http_client("eleven").stream(
+                "POST",
+                f"{UPSTREAM_URLS['eleven']}/text-to-speech/{voice_id}",
+                headers=headers,
+                json=payload
+            ) as r:
+                print("🎤 ElevenLabs status:", r.status_code)
+
+                if r.status_code != 200:
+                    await r.aread()
+                    ELEVEN_POOL.failure(api_key, t0, r.status_code, retry_after_seconds(r))
+                    print("❌ ElevenLabs error:", r.status_code, r.text[:200])
+                    continue
+
+                ogg = await transcode_stream_to_ogg(r.aiter_bytes())
+
+            ELEVEN_POOL.success(api_key, t0)
+            print("🎤 ElevenLabs voice used")
+            return ogg
+
+        except TranscodeError as e:
+            # the key worked, ffmpeg didn't: another key would pay for the
+            # same synthesis and fail the same way, so no failover
+            ELEVEN_POOL.success(api_key, t0)
+            print("ElevenLabs conversion fail:", e)
+            return None
 
         except Exception as e:
+            ELEVEN_POOL.failure(api_key, t0)
             print("🔥 ElevenLabs exception:", e)
 
+        except BaseException:
+            # cancelled: not the key's fault, but it is no longer in flight
+            ELEVEN_POOL.release(api_key)
+            raise
+
     return None
 
 OPENROUTER_KEYS = [k for k in OPENROUTER_KEYS if k]
 
-if not OPENROUTER_KEYS:
-    print("❌ No OpenRouter API keys found!")
-    exit(1)
+OPENROUTER_POOL = KeyPool("OpenRouter", OPENROUTER_KEYS)
 
 
 MODEL_NAME = "openai/gpt-4o-mini"
+AI_LIMITS_MSG = "🥺 Bestie free AI limits khatam ho gaye… thoda baad try karo 💔"
+
+# Stream replies into one Telegram message that is edited in place
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+TG_MAX_LEN = 4096
 
 SYSTEM_PROMPT = """You are Priya — a friendly Indian AI created by Subojeet Mandal.
 Speak natural Hinglish, warm and supportive.
@@ -112,152 +782,715 @@ Help with coding, studies, and daily questions clearly.
 Be simple, positive, and respectful.
 Avoid unsafe or illegal content.
 """
-app_web = Flask(__name__)
 
-@app_web.route("/")
-def home():
-    return "Priya AI Bot Running", 200
+# ================== WEB SERVER ==================
+# One aiohttp server on the bot's own event loop: health check for uptime
+# pings and Prometheus /metrics always, plus the Telegram webhook endpoint
+# when WEBHOOK_URL is set.
+# Without WEBHOOK_URL the bot long-polls (local development).
+PORT = int(os.getenv("PORT", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")   # optional bearer token for /metrics
+
+WEB_RUNNER = None
+
+async def home(request):
+    return web.Response(text="Priya AI Bot Running")
+
+async def metrics(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(text=metrics_text(), content_type="text/plain", charset="utf-8")
+
+def make_webhook_handler(app):
+    async def telegram_webhook(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await app.update_queue.put(Update.de_json(data, app.bot))
+        return web.Response()
+    return telegram_webhook
+
+async def start_web_server(app, webhook=False):
+    global WEB_RUNNER
+    web_app = web.Application()
+    web_app.router.add_get("/", home)
+    web_app.router.add_get("/metrics", metrics)
+    if webhook:
+        web_app.router.add_post(WEBHOOK_PATH, make_webhook_handler(app))
+
+    WEB_RUNNER = web.AppRunner(web_app, access_log=None)
+    await WEB_RUNNER.setup()
+    await web.TCPSite(WEB_RUNNER, "0.0.0.0", PORT).start()
+    print("🌐 Web server on port", PORT, "(webhook)" if webhook else "(health)")
+
+async def stop_web_server():
+    global WEB_RUNNER
+    if WEB_RUNNER is not None:
+        await WEB_RUNNER.cleanup()
+        WEB_RUNNER = None
 
-def run_web():
-    app_web.run(host="0.0.0.0", port=10000)
 # ================== DB ==================
-conn = sqlite3.connect("memory.db", check_same_thread=False)
-cur = conn.cursor()
+# All SQLite work runs on one writer thread that owns the connection.
+# Writes are queued and group-committed every DB_COMMIT_INTERVAL seconds;
+# reads go through the same FIFO queue and connection, so every read sees
+# all writes queued before it (read-your-writes), committed or not.
+DB_PATH = os.getenv("DB_PATH", "memory.db")
+DB_COMMIT_INTERVAL = float(os.getenv("DB_COMMIT_INTERVAL", "0.05"))
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "20"))
 
 BOT_UPDATING = False
 
-cur.execute("""CREATE TABLE IF NOT EXISTS memory(
-id INTEGER PRIMARY KEY,user_id TEXT,role TEXT,content TEXT,ts INTEGER)""")
-cur.execute("""CREATE TABLE IF NOT EXISTS profile(
-user_id TEXT PRIMARY KEY,name TEXT,voice_mode INTEGER DEFAULT 0)""")
+def init_schema(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS memory(
+    id INTEGER PRIMARY KEY,user_id TEXT,role TEXT,content TEXT,ts INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS profile(
+    user_id TEXT PRIMARY KEY,name TEXT,voice_mode INTEGER DEFAULT 0)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_user ON memory(user_id, id)")
 
-conn.commit()
-
-def ensure_voice_columns():
-    try:
-        cur.execute("ALTER TABLE profile ADD COLUMN voice_engine TEXT DEFAULT 'gtts'")
-    except:
-        pass
-    try:
-        cur.execute("ALTER TABLE profile ADD COLUMN voice_name TEXT DEFAULT ''")
-    except:
-        pass
+    # voice + broadcast columns
+    for col in ("voice_engine TEXT DEFAULT 'gtts'", "voice_name TEXT DEFAULT ''",
+                "blocked INTEGER DEFAULT 0"):
+        try:
+            conn.execute(f"ALTER TABLE profile ADD COLUMN {col}")
+        except sqlite3.OperationalError:
+            pass
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bans(
+        user_id TEXT PRIMARY KEY,
+        reason TEXT,
+        ts INTEGER
+    )
+    """)
+    conn.execute("""CREATE TABLE IF NOT EXISTS serp_cache(
+    qkey TEXT PRIMARY KEY,ctx TEXT,expires INTEGER)""")
+    conn.execute("DELETE FROM serp_cache WHERE expires<?", (int(time.time()),))
+    conn.execute("""CREATE TABLE IF NOT EXISTS summaries(
+    user_id TEXT PRIMARY KEY,summary TEXT,ts INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS tts_cache(
+    tts_key TEXT PRIMARY KEY,file_id TEXT,ts INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS image_cache(
+    prompt_key TEXT PRIMARY KEY,file_id TEXT,ts INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcasts(
+    id INTEGER PRIMARY KEY,admin_chat INTEGER,text TEXT,from_chat INTEGER,msg_id INTEGER,
+    last_uid TEXT DEFAULT '',sent INTEGER DEFAULT 0,failed INTEGER DEFAULT 0,
+    blocked INTEGER DEFAULT 0,status TEXT,ts INTEGER)""")
+
+    # v1: every user who ever chatted gets a profile row (broadcast recipients)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        conn.execute("INSERT OR IGNORE INTO profile(user_id) SELECT DISTINCT user_id FROM memory")
+        conn.execute("PRAGMA user_version=1")
     conn.commit()
 
-ensure_voice_columns()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS bans(
-    user_id TEXT PRIMARY KEY,
-    reason TEXT,
-    ts INTEGER
-)
-""")
-conn.commit()
-
+class Database:
+    def __init__(self, path, commit_interval=0.05, before_commit=None):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.before_commit = before_commit
+        self.jobs = queue.Queue()
+        self.commits = 0
+        self.loop = None       # set at startup; receives prune callbacks
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        init_schema(conn)
+        self.ready.set()
+
+        dirty_since = None
+        while True:
+            timeout = None
+            if dirty_since is not None:
+                timeout = max(0, dirty_since + self.commit_interval - time.monotonic())
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                job = ()
+
+            if job is None:
+                self._commit(conn)
+                conn.close()
+                return
+
+            if job:
+                fn, args, fut = job
+                try:
+                    result = fn(conn, *args)
+                    if fut and fut.set_running_or_notify_cancel():
+                        fut.set_result(result)
+                except Exception as e:
+                    print("DB error:", e)
+                    if fut and fut.set_running_or_notify_cancel():
+                        fut.set_exception(e)
+                if conn.in_transaction and dirty_since is None:
+                    dirty_since = time.monotonic()
+
+            if dirty_since is not None and time.monotonic() - dirty_since >= self.commit_interval:
+                self._commit(conn)
+                dirty_since = None
+
+    def _commit(self, conn):
+        try:
+            if self.before_commit:
+                self.before_commit(conn)
+            conn.commit()
+            self.commits += 1
+        except Exception as e:
+            print("DB commit error:", e)
+            conn.rollback()
+
+    def write(self, fn, *args):
+        """Queue a write; returns immediately."""
+        self.jobs.put((fn, args, None))
+
+    def submit(self, fn, *args):
+        fut = concurrent.futures.Future()
+        self.jobs.put((fn, args, fut))
+        return fut
+
+    async def run(self, fn, *args):
+        with stage_timer("db"):
+            return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+# ================== HISTORY CACHE ==================
+# Bounded per-user ring buffer of recent turns in front of load_memory.
+# save_msg keeps it in sync, misses load lazily from SQLite, and users are
+# evicted LRU-first once over HISTORY_CACHE_USERS users or
+# HISTORY_CACHE_MAX_MB of message text, or after HISTORY_CACHE_TTL seconds idle.
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "50000"))
+HISTORY_CACHE_MAX_MB = int(os.getenv("HISTORY_CACHE_MAX_MB", "256"))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "3600"))
+
+class HistoryCache:
+    def __init__(self, max_users, ttl, turns, max_bytes=HISTORY_CACHE_MAX_MB * 1024 * 1024):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.turns = turns
+        self.users = OrderedDict()   # uid -> [deque, last_used]
+        self.loading = {}            # uid -> msgs saved while a load is in flight
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _size(msg):
+        return len(msg["content"]) + 100
+
+    def get(self, uid):
+        entry = self.users.get(uid)
+        now = time.monotonic()
+        if entry is None or now - entry[1] > self.ttl:
+            if entry is not None:
+                self._drop(uid)
+            self.misses += 1
+            return None
+        entry[1] = now
+        self.users.move_to_end(uid)
+        self.hits += 1
+        return list(entry[0])
+
+    def append(self, uid, msg):
+        entry = self.users.get(uid)
+        if entry is not None:
+            hist = entry[0]
+            if len(hist) == hist.maxlen:
+                self.bytes -= self._size(hist[0])
+            hist.append(msg)
+            self.bytes += self._size(msg)
+            self._evict()
+        elif uid in self.loading:
+            self.loading[uid].append(msg)
+
+    def begin_load(self, uid):
+        self.loading.setdefault(uid, [])
+
+    def finish_load(self, uid, rows):
+        pending = self.loading.pop(uid, [])
+        if uid in self.users:
+            # a concurrent load already filled it
+            return self.get(uid)
+        hist = deque(rows + pending, maxlen=self.turns)
+        self.users[uid] = [hist, time.monotonic()]
+        self.bytes += sum(self._size(m) for m in hist)
+        self._evict()
+        return list(hist)
+
+    def abort_load(self, uid):
+        self.loading.pop(uid, None)
+
+    def _drop(self, uid):
+        hist, _ = self.users.pop(uid)
+        self.bytes -= sum(self._size(m) for m in hist)
+        self.evictions += 1
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.users:
+            uid, (_, last_used) = next(iter(self.users.items()))
+            if (len(self.users) <= self.max_users and self.bytes <= self.max_bytes
+                    and now - last_used <= self.ttl):
+                break
+            self._drop(uid)
+
+    def stats_text(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return (
+            f"🧠 History cache: {len(self.users)} users, "
+            f"~{self.bytes // 1024}/{self.max_bytes // 1024} KB, "
+            f"hit {rate:.1f}% ({self.hits}/{total}), evicted {self.evictions}"
+        )
 
-conn.commit()
+history_cache = HistoryCache(HISTORY_CACHE_USERS, HISTORY_CACHE_TTL, HISTORY_LIMIT)
 
 # ================== MEMORY ==================
-def save_msg(uid, role, content):
-    cur.execute("INSERT INTO memory(user_id,role,content,ts) VALUES(?,?,?,?)",
-                (str(uid), role, content, int(time.time())))
-    cur.execute("""DELETE FROM memory WHERE user_id=? AND id NOT IN
-        (SELECT id FROM memory WHERE user_id=? ORDER BY id DESC LIMIT 20)""",
-        (str(uid), str(uid)))
-    conn.commit()
-
-def load_memory(uid, limit=20):
-    cur.execute("SELECT role,content FROM memory WHERE user_id=? ORDER BY id DESC LIMIT ?",
-                (str(uid), limit))
-    return [{"role": r, "content": c} for r, c in cur.fetchall()[::-1]]
+# users whose history needs pruning at the next group commit (DB thread only)
+_PRUNE_USERS = set()
+
+def _insert_msg(conn, uid, role, content, ts):
+    conn.execute("INSERT INTO memory(user_id,role,content,ts) VALUES(?,?,?,?)",
+                 (uid, role, content, ts))
+    if role == "user":
+        # known recipient for broadcasts; writing again un-blocks the user
+        conn.execute("""INSERT INTO profile(user_id) VALUES(?)
+            ON CONFLICT(user_id) DO UPDATE SET blocked=0 WHERE blocked=1""", (uid,))
+    _PRUNE_USERS.add(uid)
+
+def _prune_memory(conn):
+    for uid in _PRUNE_USERS:
+        rows = conn.execute("""SELECT id,role,content FROM memory WHERE user_id=? AND id <=
+            (SELECT id FROM memory WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?)
+            ORDER BY id""",
+            (uid, uid, HISTORY_LIMIT)).fetchall()
+        if not rows:
+            continue
+        conn.execute("DELETE FROM memory WHERE user_id=? AND id<=?", (uid, rows[-1][0]))
+        # older turns → running summary (on the event loop)
+        if SUMMARY_ENABLED and db.loop is not None:
+            try:
+                db.loop.call_soon_threadsafe(
+                    schedule_summary, uid, [(r, c) for _, r, c in rows]
+                )
+            except RuntimeError:
+                pass
+    _PRUNE_USERS.clear()
+
+def _select_memory(conn, uid, limit):
+    rows = conn.execute(
+        "SELECT role,content FROM memory WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (uid, limit)
+    ).fetchall()
+    return [{"role": r, "content": c} for r, c in rows[::-1]]
+
+def _select_profile(conn, uid):
+    row = conn.execute(
+        "SELECT name,voice_mode,voice_engine,voice_name FROM profile WHERE user_id=?",
+        (uid,)
+    ).fetchone()
+    if row is None:
+        conn.execute("INSERT INTO profile(user_id) VALUES(?)", (uid,))
+    return row
+
+def _execute(conn, sql, params=()):
+    return conn.execute(sql, params).fetchall()
+
+# opened by open_storage() at startup: CPU_POOL's spawned workers re-run
+# this file as __mp_main__, so importing it must not touch the DB or disk
+db = None
 
-def get_profile(uid):
-    cur.execute("SELECT name,voice_mode FROM profile WHERE user_id=?", (str(uid),))
-    row = cur.fetchone()
-    if row:
-        return {"name": row[0] or "", "voice_mode": int(row[1] or 0)}
-    cur.execute("INSERT INTO profile(user_id) VALUES(?)", (str(uid),))
-    conn.commit()
-    return {"name": "", "voice_mode": 0}
+def save_msg(uid, role, content):
+    uid = str(uid)
+    history_cache.append(uid, {"role": role, "content": content})
+    db.write(_insert_msg, uid, role, content, int(time.time()))
+
+async def load_memory(uid, limit=HISTORY_LIMIT):
+    uid = str(uid)
+    hist = history_cache.get(uid)
+    if hist is None:
+        history_cache.begin_load(uid)
+        try:
+            rows = await db.run(_select_memory, uid, HISTORY_LIMIT)
+        except Exception:
+            history_cache.abort_load(uid)
+            raise
+        hist = history_cache.finish_load(uid, rows)
+    return hist[-limit:]
 
 def set_voice_mode(uid, val):
-    cur.execute("UPDATE profile SET voice_mode=? WHERE user_id=?",
-                (int(val), str(uid)))
-    conn.commit()
+    db.write(_execute, "UPDATE profile SET voice_mode=? WHERE user_id=?",
+             (int(val), str(uid)))
+    invalidate_user_state(uid)
 
 def set_voice(uid, engine="gtts", name=""):
-    cur.execute(
+    db.write(
+        _execute,
         "UPDATE profile SET voice_engine=?, voice_name=? WHERE user_id=?",
         (engine, name, str(uid))
     )
-    conn.commit()
-
-def get_voice(uid):
-    cur.execute(
-        "SELECT voice_engine, voice_name FROM profile WHERE user_id=?",
-        (str(uid),)
-    )
-    r = cur.fetchone()
-    return {
-        "engine": r[0] if r else "gtts",
-        "name": r[1] if r else ""
-    }
+    invalidate_user_state(uid)
+
+# ================== USER STATE ==================
+# One cached record per user (profile + voice settings), fetched with a
+# single query. Ban status comes from BANNED, loaded once at startup and
+# kept in sync by /banuser and /unbanuser, so checks never touch the DB.
+USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "100000"))
+
+@dataclass
+class UserState:
+    uid: str
+    name: str = ""
+    voice_mode: int = 0
+    voice_engine: str = "gtts"
+    voice_name: str = ""
+
+    @property
+    def banned(self):
+        return self.uid in BANNED
+
+BANNED = set()   # filled by open_storage()
+_user_states = OrderedDict()
+# uid -> [reads in flight, generation]; invalidate_user_state bumps the
+# generation so a read that started before it doesn't cache what it read.
+# Only users with a read in flight have an entry.
+_user_state_reads = {}
+
+async def get_user_state(uid):
+    uid = str(uid)
+    st = _user_states.get(uid)
+    if st is not None:
+        _user_states.move_to_end(uid)
+        return st
+
+    entry = _user_state_reads.setdefault(uid, [0, 0])
+    entry[0] += 1
+    gen = entry[1]
+    try:
+        row = await db.run(_select_profile, uid)
+    finally:
+        entry[0] -= 1
+        if entry[0] == 0:
+            del _user_state_reads[uid]
+    if row:
+        st = UserState(uid, row[0] or "", int(row[1] or 0), row[2] or "gtts", row[3] or "")
+    else:
+        st = UserState(uid)
+    if entry[1] != gen:
+        return st   # invalidated meanwhile: may be stale, don't cache it
+    _user_states[uid] = st
+    while len(_user_states) > USER_STATE_CACHE_SIZE:
+        _user_states.popitem(last=False)
+    return st
+
+def invalidate_user_state(uid):
+    uid = str(uid)
+    entry = _user_state_reads.get(uid)
+    if entry is not None:
+        entry[1] += 1
+    _user_states.pop(uid, None)
 
 def is_banned(uid):
-    cur.execute("SELECT 1 FROM bans WHERE user_id=?", (str(uid),))
-    return cur.fetchone() is not None
+    with span("ban_check"):
+        return str(uid) in BANNED
+
+# ================== CACHE UTILS ==================
+_MISSING = object()
+
+class TTLCache:
+    """Size-bounded LRU with per-entry expiry."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()   # key -> (expires_at, value)
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key, _MISSING)
+        if item is _MISSING or item[0] < time.monotonic():
+            if item is not _MISSING:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return 100 * self.hits / total if total else 0
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one upstream call."""
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        fut = self.calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self.calls[key] = fut
+            fut.add_done_callback(lambda f: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: one cancelled waiter must not cancel the shared call
+        return await asyncio.shield(fut)
+
+class DiskLRU:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()   # name -> size, oldest first
+        self.bytes = 0
+        self.hits = self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            st = os.stat(os.path.join(directory, name))
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.index[name] = size
+            self.bytes += size
+
+    def get(self, key):
+        if key not in self.index:
+            self.misses += 1
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            self.bytes -= self.index.pop(key)
+            self.misses += 1
+            return None
+        self.index.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = os.path.join(self.directory, key)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.bytes += len(data) - self.index.pop(key, 0)
+        self.index[key] = len(data)
+        while self.bytes > self.max_bytes and len(self.index) > 1:
+            old, size = self.index.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+class FileIdCache:
+    """Telegram file_ids of media we already uploaded (memory + SQLite), so
+    the same content is re-sent by file_id instead of uploaded again."""
+    def __init__(self, table, key_col):
+        self.table = table
+        self.key_col = key_col
+        self.mem = TTLCache(50000, 30 * 86400)
+        self.reused = 0
+
+    async def get(self, key):
+        file_id = self.mem.get(key)
+        if file_id is None:
+            rows = await db.run(
+                _execute, f"SELECT file_id FROM {self.table} WHERE {self.key_col}=?", (key,)
+            )
+            if rows:
+                file_id = rows[0][0]
+                self.mem.set(key, file_id)
+        return file_id
+
+    def remember(self, key, file_id):
+        self.mem.set(key, file_id)
+        db.write(
+            _execute,
+            f"INSERT OR REPLACE INTO {self.table}({self.key_col}, file_id, ts) VALUES(?,?,?)",
+            (key, file_id, int(time.time()))
+        )
+
+    def forget(self, key):
+        self.mem.data.pop(key, None)
+        db.write(_execute, f"DELETE FROM {self.table} WHERE {self.key_col}=?", (key,))
 
 # ================== YOUTUBE SEARCH ==================
-def search_youtube(query, max_results=3):
-    try:
-        yt = googleapiclient.discovery.build(
-            "youtube", "v3", developerKey=YOUTUBE_API_KEY)
-        req = yt.search().list(
-            part="snippet",
-            q=query,
-            type="video",
-            maxResults=max_results
-        )
-        res = req.execute()
-
-        ctx = "\n\n[SYSTEM: YouTube Results]\n"
-        for i in res.get("items", []):
-            title = i["snippet"]["title"]
-            channel = i["snippet"]["channelTitle"]
-            vid = i["id"]["videoId"]
-            ctx += f"- {title}\n  📺 {channel}\n  🔗 https://youtu.be/{vid}\n\n"
+YT_CACHE_TTL = int(os.getenv("YT_CACHE_TTL", "21600"))
+yt_cache = TTLCache(5000, YT_CACHE_TTL)
+yt_flight = SingleFlight()
+
+def normalize_query(q):
+    return " ".join(q.lower().split())
+
+async def _search_youtube_api(query, max_results):
+    r = await http_client("youtube").get(
+        f"{UPSTREAM_URLS['youtube']}/search",
+        params={
+            "part": "snippet",
+            "q": query,
+            "type": "video",
+            "maxResults": max_results,
+            "key": YOUTUBE_API_KEY
+        }
+    )
+    r.raise_for_status()
+    res = r.json()
+
+    ctx = "\n\n[SYSTEM: YouTube Results]\n"
+    for i in res.get("items", []):
+        title = i["snippet"]["title"]
+        channel = i["snippet"]["channelTitle"]
+        vid = i["id"]["videoId"]
+        ctx += f"- {title}\n  📺 {channel}\n  🔗 https://youtu.be/{vid}\n\n"
+    return ctx
+
+@timed("youtube")
+async def search_youtube(query, max_results=3):
+    key = (normalize_query(query), max_results)
+    ctx = yt_cache.get(key)
+    if ctx is not None:
+        return ctx
+
+    async def fetch():
+        ctx = await _search_youtube_api(query, max_results)
+        yt_cache.set(key, ctx)
         return ctx
+
+    try:
+        return await yt_flight.do(key, fetch)
     except Exception as e:
-        print("YT Error:", e)
+        print("YT Error:", repr(e))
         return ""
 
 # ================== SERP WEB SEARCH ==================
-async def search_web_serp(query, max_results=5):
-    url = "https://serpapi.com/search.json"
+# Cached per normalized query with per-category TTLs (prices/news go stale
+# fast, definitions don't) and single-flight dedup; optionally persisted to
+# SQLite so the cache survives restarts.
+SERP_CACHE_PERSIST = os.getenv("SERP_CACHE_PERSIST", "1") == "1"
+SERP_COST_PER_CALL = float(os.getenv("SERP_COST_PER_CALL", "0.015"))
+
+SERP_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "of", "for", "to", "in", "on", "me",
+    "please", "pls", "plz", "tell", "what", "whats", "who", "today", "now",
+    "current", "batao", "kya", "hai", "ka", "ki", "ke", "bhai", "bestie"
+}
+
+SERP_TTLS = [
+    # (keywords, ttl seconds) - first match wins
+    (("price", "rate", "stock", "bitcoin", "gold", "dimond", "score"), 600),
+    (("news", "latest", "today", "live"), 900),
+    (("what is", "who is", "define", "meaning"), 7 * 86400),
+]
+SERP_DEFAULT_TTL = 3600
+
+serp_cache = TTLCache(10000, SERP_DEFAULT_TTL)
+serp_flight = SingleFlight()
+serp_stats = {"db_hits": 0, "calls": 0}
+
+def serp_cache_key(query):
+    words = re.findall(r"\w+", query.lower())
+    return " ".join(w for w in words if w not in SERP_STOPWORDS) or " ".join(words)
+
+def serp_ttl(query):
+    q = query.lower()
+    for keywords, ttl in SERP_TTLS:
+        if any(k in q for k in keywords):
+            return ttl
+    return SERP_DEFAULT_TTL
+
+def _select_serp(conn, key, now):
+    row = conn.execute(
+        "SELECT ctx, expires FROM serp_cache WHERE qkey=? AND expires>?", (key, now)
+    ).fetchone()
+    return row
+
+async def _serp_fetch(query, max_results):
+    url = f"{UPSTREAM_URLS['serp']}/search.json"
     params = {
         "engine": "google",
         "q": query,
         "api_key": SERP_API_KEY,
         "num": max_results
     }
-    try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, params=params)
-            data = r.json()
+    serp_stats["calls"] += 1
+    r = await http_client("serp").get(url, params=params)
+    data = r.json()
+    if r.status_code != 200 or data.get("error"):
+        raise RuntimeError(f"SERP {r.status_code}: {data.get('error', '')}")
+
+    results = data.get("organic_results", [])
+    if not results:
+        return ""
 
-        results = data.get("organic_results", [])
-        if not results:
-            return ""
+    ctx = "\n\n[SYSTEM: Live Web Search]\n"
+    for r in results[:max_results]:
+        ctx += f"- {r.get('title','')}\n  {r.get('snippet','')}\n  🔗 {r.get('link','')}\n\n"
+    return ctx
 
-        ctx = "\n\n[SYSTEM: Live Web Search]\n"
-        for r in results[:max_results]:
-            ctx += f"- {r.get('title','')}\n  {r.get('snippet','')}\n  🔗 {r.get('link','')}\n\n"
+@timed("serp")
+async def search_web_serp(query, max_results=5):
+    key = serp_cache_key(query)
+    ctx = serp_cache.get(key)
+    if ctx is not None:
         return ctx
+
+    async def fetch():
+        ttl = serp_ttl(query)
+        if SERP_CACHE_PERSIST:
+            row = await db.run(_select_serp, key, int(time.time()))
+            if row:
+                serp_stats["db_hits"] += 1
+                serp_cache.set(key, row[0], row[1] - time.time())
+                return row[0]
+
+        ctx = await _serp_fetch(query, max_results)
+        serp_cache.set(key, ctx, ttl)
+        if SERP_CACHE_PERSIST:
+            db.write(
+                _execute,
+                "INSERT OR REPLACE INTO serp_cache(qkey, ctx, expires) VALUES(?,?,?)",
+                (key, ctx, int(time.time() + ttl))
+            )
+        return ctx
+
+    try:
+        return await serp_flight.do(key, fetch)
     except Exception as e:
         print("SERP Error:", e)
         return ""
 
+def serp_stats_text():
+    saved = serp_cache.hits + serp_stats["db_hits"] + serp_flight.coalesced
+    total = saved + serp_stats["calls"]
+    rate = 100 * saved / total if total else 0
+    return (
+        f"🔎 SERP cache: {len(serp_cache.data)} queries, hit {rate:.1f}% "
+        f"({saved}/{total}), ~${saved * SERP_COST_PER_CALL:.2f} saved"
+    )
+
 # ================== ADVANCED ZIP UTILS ==================
 def create_code_zip(text):
     """
@@ -318,56 +1551,611 @@ def create_code_zip(text):
     bio.seek(0)
     return bio
 
-# ================== OPENROUTER (MULTI API FAILOVER) ==================
-async def ask_openrouter(messages):
-    for api_key in OPENROUTER_KEYS:
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+# ================== ADMISSION CONTROL ==================
+# In front of the paid handlers (chat, voice, photo, /image): per-user token
+# buckets per category, RATE_LIMIT_<CATEGORY>="<burst>/<seconds>" (0 = off),
+# a global cap on in-flight LLM calls (LLM_MAX_INFLIGHT, the rest wait), and
+# load shedding: once too many updates or LLM calls are already waiting, new
+# ones get a fast "busy" reply instead of joining the queue (checked in the
+# update processor, before the update waits for its user lock or a slot;
+# the rate limit is checked in the handlers). All state is in memory; admins
+# are never limited.
+RATE_LIMIT_DEFAULTS = {"chat": "12/60", "voice": "6/60", "photo": "6/60", "image": "3/60"}
+RATE_LIMIT_USERS = int(os.getenv("RATE_LIMIT_USERS", "100000"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "32"))
+SHED_LLM_WAITING = int(os.getenv("SHED_LLM_WAITING", "0"))   # 0 = derived, see llm_shed_limit()
+SHED_UPDATE_WAITING = int(os.getenv("SHED_UPDATE_WAITING", "256"))
+ADMISSION_NOTICE_INTERVAL = 10   # at most one "slow down"/"busy" reply per user per 10s
+
+def _rate_limit(category):
+    burst, _, per = os.getenv(
+        f"RATE_LIMIT_{category.upper()}", RATE_LIMIT_DEFAULTS[category]
+    ).partition("/")
+    return float(burst), float(per or 60)
+
+RATE_LIMITS = {c: _rate_limit(c) for c in RATE_LIMIT_DEFAULTS}
+RATE_LIMITED_MSG = "⏳ Arre itni jaldi! Thoda ruk jao bestie, {wait}s baad phir try karo 💖"
+BUSY_MSG = "😵‍💫 Bestie abhi bahut rush hai… 1-2 min baad try karo 🙏"
+
+ADMISSION_REJECTED = Counter(
+    "priya_admission_rejected_total", "Updates turned away by admission control.",
+    ("category", "reason")
+)
 
-        payload = {
-            "model": MODEL_NAME,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 1000
-        }
+class LLMLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = asyncio.Semaphore(limit)
+        self.inflight = 0
+        self.waiting = 0
 
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        self.waiting += 1
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                r = await client.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
+            with span("wait_llm"):
+                await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+
+llm_limiter = LLMLimiter(LLM_MAX_INFLIGHT)
+
+class UserRateLimiter:
+    def __init__(self, limits, max_users):
+        self.limits = limits
+        self.max_users = max_users
+        self.buckets = OrderedDict()   # (uid, category) -> TokenBucket, LRU
+
+    def take(self, uid, category):
+        """0 if admitted, else seconds until the next token."""
+        burst, per = self.limits[category]
+        if burst <= 0:
+            return 0
+        key = (uid, category)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst / per, burst)
+            while len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)   # idle users: their bucket refilled anyway
+        self.buckets.move_to_end(key)
+        if bucket.try_take():
+            return 0
+        return max(1, int((1 - bucket.tokens) / bucket.rate + 0.999))
+
+rate_limiter = UserRateLimiter(RATE_LIMITS, RATE_LIMIT_USERS)
+_admission_notified = TTLCache(RATE_LIMIT_USERS, ADMISSION_NOTICE_INTERVAL)
+admission_stats = {"admitted": 0, "rate": 0, "shed": 0}
+
+def llm_shed_limit():
+    """SHED_LLM_WAITING, or by default half of the update handlers that can
+    queue on the LLM cap at all (those running beyond LLM_MAX_INFLIGHT)."""
+    if SHED_LLM_WAITING:
+        return SHED_LLM_WAITING
+    return max(1, (update_processor.concurrency - llm_limiter.limit) // 2)
+
+def overload_reason(category):
+    if llm_limiter.waiting >= llm_shed_limit():
+        return "llm"
+    if update_processor.waiting >= SHED_UPDATE_WAITING:
+        return "updates"
+    if category in ("voice", "photo") and CPU_POOL.pending >= CPU_POOL.limit:
+        return "cpu"
+    return None
+
+# handler name (PerUserUpdateProcessor.handler_name) -> admission category
+ADMISSION_CATEGORIES = {"text": "chat", "voice": "voice", "photo": "photo", "image": "image"}
+
+async def _admission_reply(update, text):
+    uid = update.effective_user.id
+    if _admission_notified.get(uid) is not None:
+        return
+    _admission_notified.set(uid, True)
+    try:
+        await update.effective_message.reply_text(text)
+    except Exception as e:
+        print("Admission reply error:", e)
+
+async def shed(update, category):
+    """True if the update is dropped with a "busy" reply. Called by the
+    update processor before the update waits for its user lock / a slot."""
+    uid = update.effective_user.id
+    if is_admin(uid):
+        return False
+    reason = overload_reason(category)
+    if reason is None:
+        return False
+    ADMISSION_REJECTED.inc(category, reason)
+    admission_stats["shed"] += 1
+    await _admission_reply(update, BUSY_MSG)
+    return True
+
+async def admit(update, category):
+    """True if the update may go on; otherwise replies (rate-limited)."""
+    uid = update.effective_user.id
+    if is_admin(uid):
+        return True
+
+    wait = rate_limiter.take(uid, category)
+    if not wait:
+        admission_stats["admitted"] += 1
+        return True
+
+    ADMISSION_REJECTED.inc(category, "rate")
+    admission_stats["rate"] += 1
+    await _admission_reply(update, RATE_LIMITED_MSG.format(wait=wait))
+    return False
+
+def admission_stats_text():
+    return (
+        f"🚦 Admission: admitted {admission_stats['admitted']}, "
+        f"rate-limited {admission_stats['rate']}, shed {admission_stats['shed']}, "
+        f"LLM in-flight {llm_limiter.inflight}/{llm_limiter.limit} "
+        f"(waiting {llm_limiter.waiting})"
+    )
+
+# ================== OPENROUTER (MULTI API FAILOVER) ==================
+@timed("openrouter")
+async def ask_openrouter(messages, max_tokens=1000, limiter=None):
+    async with (limiter or llm_limiter).slot():
+        for api_key in OPENROUTER_POOL.order():
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            }
+
+            payload = {
+                "model": MODEL_NAME,
+                "messages": messages,
+                "temperature": 0.7,
+                "max_tokens": max_tokens
+            }
+
+            t0 = OPENROUTER_POOL.start(api_key)
+            try:
+                r = await http_client("openrouter").post(
+                    f"{UPSTREAM_URLS['openrouter']}/chat/completions",
                     headers=headers,
                     json=payload
                 )
 
-            if r.status_code == 200:
-                data = r.json()
-                if data.get("choices"):
-                    print("✅ OpenRouter key used:", api_key[:8], "****")
-                    return data["choices"][0]["message"]["content"]
+                if r.status_code == 200:
+                    data = r.json()
+                    if data.get("choices"):
+                        OPENROUTER_POOL.success(api_key, t0)
+                        print("✅ OpenRouter key used:", api_key[:8], "****")
+                        return data["choices"][0]["message"]["content"]
+                    OPENROUTER_POOL.failure(api_key, t0, 502)
+
+                else:
+                    OPENROUTER_POOL.failure(api_key, t0, r.status_code, retry_after_seconds(r))
+                    print("⚠️ API failed → switching key", r.status_code)
+
+            except Exception as e:
+                OPENROUTER_POOL.failure(api_key, t0)
+                print("🔥 API crash → switching key", e)
+
+            except BaseException:
+                # cancelled: not the key's fault, but it is no longer in flight
+                OPENROUTER_POOL.release(api_key)
+                raise
+
+        return AI_LIMITS_MSG
+
+async def ask_openrouter_stream(messages):
+    """Yields reply text deltas as they arrive (SSE `stream: true`).
+    Fails over to the next key only while nothing has been yielded yet."""
+    async with llm_limiter.slot():
+        for api_key in OPENROUTER_POOL.order():
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json"
+            }
 
-            else:
-                print("⚠️ API failed → switching key", r.status_code)
+            payload = {
+                "model": MODEL_NAME,
+                "messages": messages,
+                "temperature": 0.7,
+                "max_tokens": 1000,
+                "stream": True
+            }
 
-        except Exception as e:
-            print("🔥 API crash → switching key", e)
+            t0 = OPENROUTER_POOL.start(api_key)
+            started = False
+            try:
+                async with http_client("openrouter").stream(
+                    "POST",
+                    f"{UPSTREAM_URLS['openrouter']}/chat/completions",
+                    headers=headers,
+                    json=payload
+                ) as r:
+                    if r.status_code != 200:
+                        await r.aread()
+                        OPENROUTER_POOL.failure(api_key, t0, r.status_code, retry_after_seconds(r))
+                        print("⚠️ API failed → switching key", r.status_code)
+                        continue
+
+                    async for line in r.aiter_lines():
+                        # ": OPENROUTER PROCESSING" keep-alive comments are skipped
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            started = True
+                            yield delta
+
+                if started:
+                    OPENROUTER_POOL.success(api_key, t0)
+                    print("✅ OpenRouter key used (stream):", api_key[:8], "****")
+                    return
+                OPENROUTER_POOL.failure(api_key, t0, 502)
+
+            except Exception as e:
+                OPENROUTER_POOL.failure(api_key, t0)
+                print("🔥 API crash → switching key", e)
+                if started:
+                    return
+
+            except BaseException:
+                # consumer stopped early (aclose/GeneratorExit) or the task was
+                # cancelled: not the key's fault, but it is no longer in flight
+                OPENROUTER_POOL.release(api_key)
+                raise
+
+        yield AI_LIMITS_MSG
+
+
+
+# ================== CONTEXT BUILDER ==================
+# Prompts are fitted into CONTEXT_TOKEN_BUDGET: system prompt and injected
+# search context first, then the running summary, then history newest-first.
+# Turns that leave the prompt (pruned from the memory table, or dropped by
+# fit_context for budget) are collected per user and folded into the running
+# summary in the background, one call per SUMMARY_MIN_TURNS turns /
+# SUMMARY_MIN_TOKENS tokens or after SUMMARY_IDLE_SECONDS of quiet, so older
+# context survives without growing the prompt or costing a call per turn.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_MIN_TURNS = int(os.getenv("SUMMARY_MIN_TURNS", "10"))
+SUMMARY_MIN_TOKENS = int(os.getenv("SUMMARY_MIN_TOKENS", "1500"))
+SUMMARY_IDLE_SECONDS = float(os.getenv("SUMMARY_IDLE_SECONDS", "300"))
+# summaries are background work: their own small cap, so they never take
+# (or queue for) llm_limiter slots that user replies are waiting on
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "2"))
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+summary_cache = TTLCache(100000, 3600)
+_summary_tasks = {}
+summary_limiter = LLMLimiter(SUMMARY_CONCURRENCY)
+_summary_pending = {}   # uid -> [turns, tokens, idle timer handle]
+# recently queued turns per user: a turn dropped by fit_context is pruned
+# from the table later on and must not be summarized twice
+_summary_seen = TTLCache(HISTORY_CACHE_USERS, 7 * 86400)
+context_stats = {"prompts": 0, "tokens": 0, "max": 0, "summaries": 0}
+
+async def get_summary(uid):
+    uid = str(uid)
+    summary = summary_cache.get(uid)
+    if summary is None:
+        rows = await db.run(_execute, "SELECT summary FROM summaries WHERE user_id=?", (uid,))
+        summary = rows[0][0] if rows else ""
+        summary_cache.set(uid, summary)
+    return summary
+
+@timed("memory")
+async def load_context(uid):
+    return await asyncio.gather(load_memory(uid), get_summary(uid))
+
+def fit_context(history, summary, extras=(), uid=None):
+    budget = CONTEXT_TOKEN_BUDGET - count_tokens(SYSTEM_PROMPT)
+    budget -= sum(count_tokens(e) for e in extras)
+
+    head = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        note = f"[SYSTEM: Conversation so far]\n{summary}"
+        budget -= count_tokens(note)
+        head.append({"role": "system", "content": note})
+
+    picked = []
+    for m in reversed(history):
+        t = count_tokens(m["content"]) + 4
+        if t > budget:
+            if not picked:
+                # the newest turn always goes in, trimmed if it must be
+                keep = max(budget, 200) * 4
+                picked.append({"role": m["role"], "content": m["content"][-keep:]})
+            break
+        picked.append(m)
+        budget -= t
+
+    dropped = history[:len(history) - len(picked)]
+    if dropped and uid is not None and SUMMARY_ENABLED:
+        schedule_summary(uid, [(m["role"], m["content"]) for m in dropped])
+
+    messages = head + picked[::-1]
+    messages += [{"role": "system", "content": e} for e in extras]
+
+    used = CONTEXT_TOKEN_BUDGET - budget
+    context_stats["prompts"] += 1
+    context_stats["tokens"] += used
+    context_stats["max"] = max(context_stats["max"], used)
+    return messages
+
+def schedule_summary(uid, turns):
+    """Queues (role, content) turns that left the prompt; runs on the loop."""
+    uid = str(uid)
+    seen = _summary_seen.get(uid)
+    if seen is None:
+        seen = deque(maxlen=4 * HISTORY_LIMIT)
+    _summary_seen.set(uid, seen)
+
+    entry = _summary_pending.get(uid)
+    added = 0
+    for role, content in turns:
+        key = hash((role, content))
+        if key in seen:
+            continue
+        seen.append(key)
+        if entry is None:
+            entry = _summary_pending[uid] = [[], 0, None]
+        entry[0].append((role, content))
+        entry[1] += count_tokens(content)
+        added += 1
+    if not added:
+        return
 
-    return "🥺 Bestie free AI limits khatam ho gaye… thoda baad try karo 💔"
+    if entry[2] is not None:
+        entry[2].cancel()
+    if len(entry[0]) >= SUMMARY_MIN_TURNS or entry[1] >= SUMMARY_MIN_TOKENS:
+        flush_summary(uid)
+    else:
+        entry[2] = asyncio.get_running_loop().call_later(
+            SUMMARY_IDLE_SECONDS, flush_summary, uid
+        )
 
+def flush_summary(uid):
+    entry = _summary_pending.pop(uid, None)
+    if entry is None:
+        return
+    if entry[2] is not None:
+        entry[2].cancel()
+    prev = _summary_tasks.get(uid)
+    _summary_tasks[uid] = asyncio.ensure_future(_update_summary(uid, entry[0], prev))
+
+async def flush_summaries(timeout=10):
+    """Shutdown: summarize whatever is still queued (those rows are gone)."""
+    for uid in list(_summary_pending):
+        flush_summary(uid)
+    if _summary_tasks:
+        await asyncio.wait(list(_summary_tasks.values()), timeout=timeout)
+
+async def _update_summary(uid, turns, prev):
+    try:
+        if prev is not None:
+            await asyncio.wait([prev])
+        old = await get_summary(uid)
+        convo = "\n".join(f"{role}: {content[:1500]}" for role, content in turns)
+        reply = await ask_openrouter([
+            {"role": "system", "content":
+                "You maintain a short running summary of a chat between a user and Priya. "
+                "Merge the new turns into the summary. Keep names, facts, preferences and "
+                "open tasks; drop small talk and code. Max 150 words."},
+            {"role": "user", "content": f"Summary so far:\n{old or '(none)'}\n\nNew turns:\n{convo}"}
+        ], max_tokens=SUMMARY_MAX_TOKENS, limiter=summary_limiter)
+        if reply == AI_LIMITS_MSG:
+            return
+        summary_cache.set(uid, reply)
+        db.write(
+            _execute,
+            "INSERT OR REPLACE INTO summaries(user_id, summary, ts) VALUES(?,?,?)",
+            (uid, reply, int(time.time()))
+        )
+        context_stats["summaries"] += 1
+    except Exception as e:
+        print("Summary error:", e)
+    finally:
+        if _summary_tasks.get(uid) is asyncio.current_task():
+            del _summary_tasks[uid]
+
+def context_stats_text():
+    avg = context_stats["tokens"] // context_stats["prompts"] if context_stats["prompts"] else 0
+    return (
+        f"📏 Prompt: avg {avg} / max {context_stats['max']} tokens "
+        f"(budget {CONTEXT_TOKEN_BUDGET}), summaries {context_stats['summaries']}, "
+        f"queued for {len(_summary_pending)} users"
+    )
+
+# ================== RESPONSE CACHE ==================
+# Opt-in (RESPONSE_CACHE=1) cache for short, context-free prompts like "hi" or
+# "who are you". Exact matches use the normalized text; near-duplicates are
+# found with MinHash over character 3-gram shingles plus LSH banding, then
+# confirmed by Jaccard similarity, and only count when both prompts have the
+# same content words and numbers (filler and word order may differ: "prime"
+# vs "even" or "1500" vs "2500" is a different question). The cache is only used (looked up or
+# stored) when the user has no prior history or summary, and prompts that
+# pulled in live search skip it.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.8"))
+RESPONSE_CACHE_MAX_LEN = 120
+
+CONTEXT_WORDS = {
+    "it", "this", "that", "these", "those", "above", "previous", "again", "same",
+    "continue", "more", "also", "wo", "woh", "ye", "yeh", "usko", "isko", "uska", "iska"
+}
+# prompts made only of these (or numbers) answer something: "yes", "2",
+# "why?", "aur batao", "explain in hindi"
+REPLY_WORDS = {
+    "yes", "yeah", "yep", "no", "nope", "ok", "okay", "k", "sure", "done", "right",
+    "haan", "han", "ha", "hmm", "nahi", "na", "thik", "theek", "hai", "accha", "acha",
+    "why", "kyun", "kyu", "kya", "aur", "phir", "then", "batao", "bolo", "samjhao",
+    "explain", "tell", "me", "in", "mein", "hindi", "english", "please", "pls", "option"
+}
+
+# ignored when comparing near-duplicate prompts
+FILLER_WORDS = {
+    "a", "an", "the", "is", "are", "am", "to", "of", "please", "pls", "plz", "kindly",
+    "can", "could", "would", "me", "just", "hi", "hey", "hello", "bro", "bhai", "yaar",
+    "bestie", "ji", "priya", "na", "hai", "ho", "ka", "ki", "ke", "ko", "mujhe"
+}
+
+def normalize_prompt(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def content_words(norm):
+    return frozenset(norm.split()) - FILLER_WORDS
+
+def is_context_free(text):
+    norm = normalize_prompt(text)
+    if not norm or len(norm) > RESPONSE_CACHE_MAX_LEN:
+        return False
+    words = set(norm.split())
+    if words & CONTEXT_WORDS:
+        return False
+    return not all(w in REPLY_WORDS or w.isdigit() for w in words)
+
+class ResponseCache:
+    def __init__(self, maxsize, ttl, threshold, num_perm=32, bands=8):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.seeds = [random.Random(i).getrandbits(32) for i in range(num_perm)]
+        self.entries = OrderedDict()   # norm -> (expires_at, reply, shingles, band keys, content words)
+        self.buckets = {}              # band key -> set of norms
+        self.exact_hits = self.near_hits = self.misses = 0
+
+    @staticmethod
+    def _shingles(norm):
+        padded = f" {norm} "
+        return {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+
+    def _band_keys(self, shingles):
+        sig = [min(hash((seed, sh)) for sh in shingles) for seed in self.seeds]
+        return [
+            (b, tuple(sig[b * self.rows:(b + 1) * self.rows]))
+            for b in range(self.bands)
+        ]
+
+    def _drop(self, norm):
+        keys = self.entries.pop(norm)[3]
+        for k in keys:
+            bucket = self.buckets.get(k)
+            if bucket:
+                bucket.discard(norm)
+                if not bucket:
+                    del self.buckets[k]
+
+    def get(self, text):
+        norm = normalize_prompt(text)
+        now = time.monotonic()
+        entry = self.entries.get(norm)
+        if entry and entry[0] > now:
+            self.entries.move_to_end(norm)
+            self.exact_hits += 1
+            return entry[1]
+
+        shingles = self._shingles(norm)
+        words = content_words(norm)
+        best, best_sim = None, self.threshold
+        for k in self._band_keys(shingles):
+            for cand in self.buckets.get(k, ()):
+                c = self.entries[cand]
+                if c[0] <= now or c[4] != words:
+                    continue
+                sim = len(shingles & c[2]) / len(shingles | c[2])
+                if sim >= best_sim:
+                    best, best_sim = cand, sim
+        if best is not None:
+            self.entries.move_to_end(best)
+            self.near_hits += 1
+            return self.entries[best][1]
+
+        self.misses += 1
+        return None
+
+    def set(self, text, reply):
+        norm = normalize_prompt(text)
+        if norm in self.entries:
+            self._drop(norm)
+        shingles = self._shingles(norm)
+        keys = self._band_keys(shingles)
+        self.entries[norm] = (
+            time.monotonic() + self.ttl, reply, shingles, keys, content_words(norm)
+        )
+        for k in keys:
+            self.buckets.setdefault(k, set()).add(norm)
+        while len(self.entries) > self.maxsize:
+            self._drop(next(iter(self.entries)))
+
+    def stats_text(self):
+        hits = self.exact_hits + self.near_hits
+        total = hits + self.misses
+        rate = 100 * hits / total if total else 0
+        keys = OPENROUTER_POOL.state.values()
+        avg_llm = sum(st["ewma"] for st in keys) / max(1, len(keys))
+        return (
+            f"💬 Response cache: {len(self.entries)} prompts, hit {rate:.1f}% "
+            f"(exact {self.exact_hits}, near {self.near_hits}), ~{hits * avg_llm:.0f}s LLM time saved"
+        )
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY
+)
 
 # ================== IMAGE GENERATION (POLLINATIONS) ==================
+# /image results are cached per sanitized prompt: the Telegram file_id from
+# the first upload (re-sent with no generation and no upload), optionally the
+# bytes on disk (IMAGE_CACHE_MAX_MB, 0 = off), and concurrent requests for the
+# same prompt share one upstream generation.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "200"))
+
+image_disk = None   # DiskLRU, opened by open_storage() (stays None when off)
+image_file_ids = FileIdCache("image_cache", "prompt_key")
+image_flight = SingleFlight()
+image_stats = {"generated": 0}
+
+def sanitize_image_prompt(prompt):
+    return re.sub(r"[^\w\s]", "", prompt).strip()
+
+def image_cache_key(prompt):
+    return hashlib.sha256(normalize_query(sanitize_image_prompt(prompt)).encode()).hexdigest()
+
+@timed("image")
 async def generate_image_pollinations(prompt: str):
     try:
-        prompt = re.sub(r"[^\w\s]", "", prompt).strip()
+        prompt = sanitize_image_prompt(prompt)
         if not prompt:
             return None
 
-        url = f"https://image.pollinations.ai/prompt/{prompt}"
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.get(url)
+        url = f"{UPSTREAM_URLS['pollinations']}/prompt/{prompt}"
+        r = await http_client("pollinations").get(url)
 
         if r.status_code == 200:
+            image_stats["generated"] += 1
             bio = BytesIO(r.content)
             bio.seek(0)
             return bio
@@ -379,13 +2167,82 @@ async def generate_image_pollinations(prompt: str):
         print("Image gen error:", e)
         return None
 
-# ================== IMAGE TO TEXT ==================
-async def image_to_text(image_bytes):
+async def generate_image_cached(prompt):
+    """Image bytes for `prompt` from disk, or one shared upstream generation."""
+    key = image_cache_key(prompt)
+    data = image_disk.get(key) if image_disk else None
+    if data:
+        return data
+
+    async def generate():
+        bio = await generate_image_pollinations(prompt)
+        if bio is None:
+            return None
+        data = bio.getvalue()
+        if image_disk:
+            image_disk.put(key, data)
+        return data
+
+    return await image_flight.do(key, generate)
+
+def image_stats_text():
+    return (
+        f"🖼 Image cache: file_id reuse {image_file_ids.reused}, "
+        f"disk hits {image_disk.hits if image_disk else 0}, "
+        f"coalesced {image_flight.coalesced}, generated {image_stats['generated']}"
+    )
+
+# ================== PHOTO UNDERSTANDING ==================
+# One multimodal completion per new photo: the smallest Telegram size that
+# covers PHOTO_MIN_SIDE is downloaded, downscaled in a worker process if it
+# is still over PHOTO_MAX_SIDE, and sent together with the history. The model
+# opens its reply with an "[Image: ...]" tag; that description is stored in
+# history and cached by file_unique_id, so a forwarded or repeated photo is
+# answered with a text-only call.
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "512"))
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1024"))
+PHOTO_JPEG_QUALITY = 80
+
+try:
+    import PIL  # noqa: F401
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+IMAGE_TAG_RE = re.compile(r"\s*\[Image:\s*(.*?)\]\s*", re.DOTALL)
+IMAGE_TAG_PROMPT = (
+    "The user sent this image. Start your answer with one line "
+    "`[Image: <one-sentence description>]`, then reply to the user naturally."
+)
+
+photo_descriptions = TTLCache(20000, 7 * 86400)
+
+def pick_photo_size(sizes):
+    """Smallest PhotoSize whose longest side reaches PHOTO_MIN_SIDE."""
+    for p in sorted(sizes, key=lambda p: p.width * p.height):
+        if max(p.width, p.height) >= PHOTO_MIN_SIDE:
+            return p
+    return sizes[-1]
+
+@timed("downscale")
+async def prepare_photo(image_bytes, size):
+    if PIL_AVAILABLE and max(size.width, size.height) > PHOTO_MAX_SIDE:
+        try:
+            return await CPU_POOL.run(
+                workers.downscale_jpeg, image_bytes, PHOTO_MAX_SIDE, PHOTO_JPEG_QUALITY,
+                timeout=TRANSCODE_TIMEOUT
+            )
+        except Exception as e:
+            print("Photo downscale error:", repr(e))
+    return image_bytes
+
+def photo_message(image_bytes, caption=""):
     b64 = base64.b64encode(image_bytes).decode()
-    messages = [{
+    text = IMAGE_TAG_PROMPT + (f"\nUser caption: {caption}" if caption else "")
+    return {
         "role": "user",
         "content": [
-            {"type": "text", "text": "Describe this image clearly and in detail."},
+            {"type": "text", "text": text},
             {
                 "type": "image_url",
                 "image_url": {
@@ -393,26 +2250,111 @@ async def image_to_text(image_bytes):
                 }
             }
         ]
-    }]
-    return await ask_openrouter(messages)
+    }
 
-def text_to_speech_bytes(text):
-    text = re.sub(r"```.*?```", "Code attached.", text, flags=re.DOTALL)
+def split_image_reply(raw):
+    m = IMAGE_TAG_RE.match(raw)
+    if not m:
+        return "", raw
+    return m.group(1).strip(), raw[m.end():]
+
+async def strip_image_tag(deltas, out):
+    """Passes a reply stream through, holding back the leading [Image: ...] tag."""
+    buf = ""
+    passing = False
+    async for d in deltas:
+        if passing:
+            yield d
+            continue
+        buf += d
+        m = IMAGE_TAG_RE.match(buf)
+        if m and "]" in buf:
+            out["description"] = m.group(1).strip()
+            passing = True
+            if buf[m.end():]:
+                yield buf[m.end():]
+        elif not "[Image:".startswith(buf.lstrip()[:7]) or len(buf) > 500:
+            passing = True
+            yield buf
+    if not passing and buf:
+        yield buf
+
+def _gtts_sync(text):
     tts = gTTS(text=text[:500], lang="en", tld="co.in")
     bio = BytesIO()
     tts.write_to_fp(bio)
     bio.seek(0)
     return bio
 
-def voice_to_text(file_bytes):
-    r = sr.Recognizer()
-    with BytesIO(file_bytes) as f:
-        with sr.AudioFile(f) as src:
-            audio = r.record(src)
+@timed("gtts")
+async def text_to_speech_bytes(text):
+    text = re.sub(r"```.*?```", "Code attached.", text, flags=re.DOTALL)
     try:
+        return await IO_POOL.run(_gtts_sync, text, timeout=GTTS_TIMEOUT)
+    except Exception as e:
+        print("gTTS error:", repr(e))
+        return None
+
+# ================== VOICE TRANSCRIPTION ==================
+# Voice notes are decoded with ffmpeg and split on silence in a worker
+# process; the chunks are recognized concurrently and stitched back together,
+# so a long note takes about as long as its longest chunk. The recognizer is
+# pluggable (VOICE_BACKEND) and transcripts are cached by file_unique_id.
+VOICE_BACKEND = os.getenv("VOICE_BACKEND", "google")
+VOICE_CHUNK_MAX_S = int(os.getenv("VOICE_CHUNK_MAX_S", "30"))
+VOICE_FALLBACK = "Voice clear nahi aaia 😅"
+
+class GoogleTranscriber:
+    def transcribe(self, wav_bytes):
+        r = sr.Recognizer()
+        with BytesIO(wav_bytes) as f:
+            with sr.AudioFile(f) as src:
+                audio = r.record(src)
         return r.recognize_google(audio)
-    except:
-        return "Voice clear nahi aaia 😅"
+
+class StandInTranscriber:
+    """Local stand-in (tests, benchmarks): no network, reports chunk length."""
+    def transcribe(self, wav_bytes):
+        seconds = max(0, len(wav_bytes) - 44) / (2 * 16000)
+        return f"[voice {seconds:.1f}s]"
+
+TRANSCRIBERS = {"google": GoogleTranscriber, "standin": StandInTranscriber}
+transcriber = TRANSCRIBERS[VOICE_BACKEND]()
+transcripts = TTLCache(20000, 7 * 86400)
+
+def set_transcriber(backend):
+    """Swaps the recognizer at runtime: any object with transcribe(wav) -> str
+    (bench.py and the tests install StandInTranscriber-style stand-ins)."""
+    global transcriber
+    transcriber = backend
+
+@timed("stt")
+async def voice_to_text(file_bytes, file_unique_id=None):
+    if file_unique_id:
+        cached = transcripts.get(file_unique_id)
+        if cached is not None:
+            return cached
+
+    try:
+        chunks = await CPU_POOL.run(
+            functools.partial(workers.decode_and_split, timeout=TRANSCODE_TIMEOUT),
+            file_bytes, VOICE_CHUNK_MAX_S, timeout=TRANSCODE_TIMEOUT
+        )
+    except Exception as e:
+        print("Voice decode error:", repr(e))
+        return VOICE_FALLBACK
+
+    results = await asyncio.gather(
+        *[IO_POOL.run(transcriber.transcribe, c, timeout=STT_TIMEOUT) for c in chunks],
+        return_exceptions=True
+    )
+    text = " ".join(r.strip() for r in results if isinstance(r, str) and r.strip())
+    if not text:
+        return VOICE_FALLBACK
+
+    if file_unique_id:
+        transcripts.set(file_unique_id, text)
+    return text
 
 async def safe_action(bot, chat_id, action=ChatAction.TYPING):
     try:
@@ -424,15 +2366,135 @@ async def download_file(bot, file_id):
     file = await bot.get_file(file_id)
     return bytes(await file.download_as_bytearray())
 
+# ================== TTS CACHE ==================
+# Synthesized voice replies are content-addressed by (engine, voice, text).
+# The final audio bytes sit in a size-bounded LRU directory, and the
+# Telegram file_id of the first upload is remembered so repeats are sent
+# by file_id with no synthesis and no upload.
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_MB = int(os.getenv("TTS_CACHE_MAX_MB", "200"))
+
+tts_disk = None   # DiskLRU, opened by open_storage()
+tts_file_ids = FileIdCache("tts_cache", "tts_key")
+tts_stats = {"synth": 0}
+
+def tts_cache_key(engine, voice, text):
+    limit = 800 if engine == "eleven" else 500
+    clean = re.sub(r"```.*?```", "Code attached.", text, flags=re.DOTALL)[:limit]
+    return hashlib.sha256(f"{engine}|{voice}|{clean}".encode()).hexdigest()
+
+async def synthesize_voice(text, engine, voice):
+    tts_stats["synth"] += 1
+    if engine == "eleven":
+        # ElevenLabs → ffmpeg → OGG/Opus, streamed
+        return await eleven_tts(text, voice)
+
+    bio = await text_to_speech_bytes(text)
+    return bio.getvalue() if bio else None
+
+async def send_voice_reply(update, text, engine, voice):
+    key = tts_cache_key(engine, voice, text)
+
+    file_id = await tts_file_ids.get(key)
+    if file_id:
+        try:
+            await update.message.reply_voice(voice=file_id)
+            tts_file_ids.reused += 1
+            return True
+        except BadRequest as e:
+            print("Cached voice file_id rejected:", e)
+            tts_file_ids.forget(key)
+
+    data = tts_disk.get(key)
+    if data is None:
+        data = await synthesize_voice(text, engine, voice)
+        if not data:
+            return False
+        tts_disk.put(key, data)
+
+    msg = await update.message.reply_voice(
+        voice=InputFile(BytesIO(data), "reply.ogg")
+    )
+    media = msg.voice or msg.audio or msg.document
+    if media:
+        tts_file_ids.remember(key, media.file_id)
+    return True
+
+def tts_stats_text():
+    return (
+        f"🎙 TTS cache: {len(tts_disk.index)} clips, {tts_disk.bytes // 1024} KB, "
+        f"file_id reuse {tts_file_ids.reused}, disk hits {tts_disk.hits}, "
+        f"synthesized {tts_stats['synth']}"
+    )
+
+# ================== MEDIA QUEUE ==================
+# ZIP building, TTS and voice/document uploads run after the text reply on a
+# bounded background queue: MEDIA_WORKERS jobs at a time, one user's jobs in
+# order, and once MEDIA_QUEUE_MAX jobs are waiting new replies go text-only.
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "8"))
+MEDIA_QUEUE_MAX = int(os.getenv("MEDIA_QUEUE_MAX", "200"))
+
+class MediaQueue:
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.slots = None
+        self.tails = {}        # uid -> last job task, for per-user ordering
+        self.pending = 0
+        self.done = 0
+        self.dropped = 0
+        self.latency = 0.0     # EWMA enqueue → finish, seconds
+
+    def submit(self, uid, fn, *args):
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            print("📦 Media queue full → text only")
+            return False
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        self.pending += 1
+        prev = self.tails.get(uid)
+        task = asyncio.ensure_future(self._run(uid, prev, fn, args, time.monotonic()))
+        self.tails[uid] = task
+        return True
+
+    async def _run(self, uid, prev, fn, args, t0):
+        try:
+            if prev is not None:
+                await asyncio.wait([prev])
+            async with self.slots:
+                with trace("media", job=fn.__name__, uid=uid):
+                    await fn(*args)
+        except Exception as e:
+            print("Media job error:", e)
+        finally:
+            self.pending -= 1
+            self.done += 1
+            self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - t0)
+            if self.tails.get(uid) is asyncio.current_task():
+                del self.tails[uid]
+
+    def stats_text(self):
+        return (
+            f"📦 Media queue: depth {self.pending}/{self.max_pending}, done {self.done}, "
+            f"dropped {self.dropped}, latency ~{self.latency:.1f}s"
+        )
+
+media_queue = MediaQueue(MEDIA_WORKERS, MEDIA_QUEUE_MAX)
+
 # ================== SEND REPLY ==================
 async def send_reply(update, text):
     uid = update.effective_user.id
 
     # ✅ TEXT ALWAYS SEND (ONLY ONCE)
     await update.message.reply_text(text)
+    media_queue.submit(uid, send_media, update, text)
 
-    profile = get_profile(uid)
-    if profile["voice_mode"] == 0:
+async def send_media(update, text):
+    uid = update.effective_user.id
+
+    state = await get_user_state(uid)
+    if state.voice_mode == 0:
         return  # 🔕 voice OFF → sirf text
 
     # ================== ZIP ==================
@@ -444,36 +2506,276 @@ async def send_reply(update, text):
         )
 
     # ================== VOICE ==================
-    v = get_voice(uid)  # returns dict: {"engine": "gtts"/"eleven", "name": "Priya"}
-    bio = None
+    if state.voice_engine == "eleven" and state.voice_name:
+        if await send_voice_reply(update, text, "eleven", state.voice_name):
+            return
+    # If ElevenLabs failed or not selected, fallback to gTTS
+    await send_voice_reply(update, text, "gtts", "")
+
+# ================== STREAMING REPLY ==================
+@timed("reply")
+async def stream_reply(update, messages, deltas=None):
+    """Posts the reply as soon as the first tokens arrive and keeps editing
+    it in place (at most once per STREAM_EDIT_INTERVAL). Long replies roll
+    over into a new message at Telegram's length limit. `deltas` overrides
+    the default OpenRouter stream for `messages`."""
+    text = ""
+    offset = 0          # where the current Telegram message starts in `text`
+    msg = None
+    shown = ""
+    next_edit = 0.0
+    t0 = time.perf_counter()
+
+    async def flush(final=False):
+        nonlocal msg, shown, offset, next_edit
+        retries = 2 if final else 0
+        while True:
+            part = text[offset:]
+            full = len(part) > TG_MAX_LEN
+            if full:
+                cut = part.rfind("\n", 0, TG_MAX_LEN)
+                part = part[:cut if cut > 0 else TG_MAX_LEN]
+
+            if part.strip() and part != shown:
+                try:
+                    if msg is None:
+                        msg = await update.message.reply_text(part)
+                    else:
+                        await msg.edit_text(part)
+                    shown = part
+                except RetryAfter as e:
+                    next_edit = time.monotonic() + e.retry_after
+                    if not final:
+                        return
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        print("Stream edit error:", e)
+                        next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                        return
+                except TelegramError as e:
+                    # TimedOut / NetworkError / Forbidden: best effort, try
+                    # again at the next edit (the final flush retries a bit)
+                    print("Stream send error:", repr(e))
+                    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                    if retries <= 0:
+                        return
+                    retries -= 1
+                    await asyncio.sleep(1)
+                    continue
+                next_edit = max(next_edit, time.monotonic() + STREAM_EDIT_INTERVAL)
+
+            if not full:
+                return
+            # current message is full → continue in a new one
+            offset += len(part)
+            msg, shown = None, ""
+
+    try:
+        async for delta in deltas or ask_openrouter_stream(messages):
+            if not text:
+                STAGE_SECONDS.observe(time.perf_counter() - t0, "first_token")
+            text += delta
+            if time.monotonic() >= next_edit:
+                await flush()
+    except Exception as e:
+        # keep whatever arrived; the caller still saves and delivers it
+        print("Stream reply error:", repr(e))
+        if not text.strip():
+            text = AI_LIMITS_MSG
+
+    await flush(final=True)
+    return text
+
+async def answer(update, messages):
+    """Ask the AI, store the reply and deliver it (streamed or in one go)."""
+    uid = update.effective_user.id
+    if STREAM_REPLIES:
+        reply = await stream_reply(update, messages)
+        save_msg(uid, "assistant", reply)
+        media_queue.submit(uid, send_media, update, reply)
+    else:
+        reply = await ask_openrouter(messages)
+        save_msg(uid, "assistant", reply)
+        await send_reply(update, reply)
+    return reply
+
+# ================== CONTEXT FAN-OUT ==================
+# Context providers run concurrently, each with its own timeout budget, under
+# one overall deadline. Anything late or failing is dropped, not awaited.
+CONTEXT_DEADLINE = float(os.getenv("CONTEXT_DEADLINE", "6"))
+YT_CONTEXT_TIMEOUT = float(os.getenv("YT_CONTEXT_TIMEOUT", "4"))
+SERP_CONTEXT_TIMEOUT = float(os.getenv("SERP_CONTEXT_TIMEOUT", "6"))
+
+@timed("context")
+async def gather_context(providers, deadline=CONTEXT_DEADLINE):
+    """providers: {name: (coroutine, timeout)} → {name: result} for the ones that made it."""
+    tasks = {
+        name: asyncio.ensure_future(asyncio.wait_for(coro, timeout))
+        for name, (coro, timeout) in providers.items()
+    }
+    if not tasks:
+        return {}
+
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for t in pending:
+        t.cancel()
+
+    results = {}
+    for name, t in tasks.items():
+        if t in done and t.exception() is None:
+            results[name] = t.result()
+        else:
+            print("⏱ Context dropped:", name)
+    return results
+
+# ================== BROADCAST ENGINE ==================
+# /all_send runs in the background: recipients come from the profile table
+# (primary key order), sends run concurrently under a global token bucket
+# sized for Telegram's ~30 msg/s cap, flood-waits pause the whole bucket,
+# and progress is checkpointed per batch so a restart resumes where it was.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_PROGRESS_EVERY = 5
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+
+    def try_take(self, n=1):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def take(self, n=1):
+        while not self.try_take(n):
+            wait = max(self.paused_until - time.monotonic(), (n - self.tokens) / self.rate)
+            await asyncio.sleep(max(wait, 0.01))
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.last = self.paused_until   # refill starts when the pause ends
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+
+def _insert_broadcast(conn, admin_chat, text, from_chat, msg_id):
+    cur = conn.execute(
+        """INSERT INTO broadcasts(admin_chat,text,from_chat,msg_id,status,ts)
+        VALUES(?,?,?,?,'running',?)""",
+        (admin_chat, text, from_chat, msg_id, int(time.time()))
+    )
+    return cur.lastrowid
 
-    if v["engine"] == "eleven" and v["name"]:
+async def broadcast_one(bot, uid, b):
+    for _ in range(3):
+        await broadcast_bucket.take()
         try:
-            # ElevenLabs async call
-            bio_mp3 = await eleven_tts(text, v["name"])
-            if bio_mp3:
-                # Convert MP3 → OGG for Telegram
-                from pydub import AudioSegment
-                bio_mp3.seek(0)
-                audio = AudioSegment.from_file(bio_mp3, format="mp3")
-                bio_ogg = BytesIO()
-                audio.export(bio_ogg, format="ogg")
-                bio_ogg.seek(0)
-                bio = bio_ogg
+            if b["text"]:
+                await bot.send_message(uid, b["text"])
+            else:
+                await bot.copy_message(uid, b["from_chat"], b["msg_id"])
+            return "sent"
+        except RetryAfter as e:
+            broadcast_bucket.pause(e.retry_after)
+        except Forbidden:
+            db.write(_execute, "UPDATE profile SET blocked=1 WHERE user_id=?", (uid,))
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                db.write(_execute, "UPDATE profile SET blocked=1 WHERE user_id=?", (uid,))
+                return "blocked"
+            print("Broadcast error:", uid, e)
+            return "failed"
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(1)
         except Exception as e:
-            print("ElevenLabs conversion fail:", e)
-            bio = None  # fallback gTTS
-
-    # If ElevenLabs failed or not selected, fallback to gTTS
-    if not bio:
-        bio = text_to_speech_bytes(text)
+            print("Broadcast error:", uid, e)
+            return "failed"
+    return "failed"
+
+async def run_broadcast(bot, bid):
+    rows = await db.run(
+        _execute,
+        "SELECT admin_chat,text,from_chat,msg_id,last_uid,sent,failed,blocked FROM broadcasts WHERE id=?",
+        (bid,)
+    )
+    if not rows:
+        return
+    admin_chat, text, from_chat, msg_id, last_uid, sent, failed, blocked = rows[0]
+    b = {"text": text, "from_chat": from_chat, "msg_id": msg_id}
+    left = (await db.run(
+        _execute, "SELECT COUNT(*) FROM profile WHERE blocked=0 AND user_id>?", (last_uid,)
+    ))[0][0]
+    total = sent + failed + blocked + left
+
+    def progress(done=False):
+        head = "✅ Broadcast" if done else "📣 Broadcast"
+        return (
+            f"{head} #{bid}: {sent + failed + blocked}/{total}\n"
+            f"sent {sent} · failed {failed} · blocked {blocked}"
+        )
 
-    # Send voice reply
-    if bio:
-        await update.message.reply_voice(
-            voice=InputFile(bio, "reply.ogg")
+    status = None
+    try:
+        status = await bot.send_message(admin_chat, progress())
+    except Exception as e:
+        print("Broadcast status error:", e)
+    last_report = time.monotonic()
+
+    while True:
+        batch = await db.run(
+            _execute,
+            "SELECT user_id FROM profile WHERE blocked=0 AND user_id>? ORDER BY user_id LIMIT ?",
+            (last_uid, BROADCAST_BATCH)
+        )
+        if not batch:
+            break
+        uids = [r[0] for r in batch]
+        results = await asyncio.gather(*[broadcast_one(bot, uid, b) for uid in uids])
+        sent += results.count("sent")
+        failed += results.count("failed")
+        blocked += results.count("blocked")
+        last_uid = uids[-1]
+        db.write(
+            _execute,
+            "UPDATE broadcasts SET last_uid=?,sent=?,failed=?,blocked=? WHERE id=?",
+            (last_uid, sent, failed, blocked, bid)
         )
 
+        if status and time.monotonic() - last_report >= BROADCAST_PROGRESS_EVERY:
+            last_report = time.monotonic()
+            try:
+                await status.edit_text(progress())
+            except Exception:
+                pass
+
+    db.write(_execute, "UPDATE broadcasts SET status='done' WHERE id=?", (bid,))
+    try:
+        if status:
+            await status.edit_text(progress(done=True))
+        else:
+            await bot.send_message(admin_chat, progress(done=True))
+    except Exception as e:
+        print("Broadcast status error:", e)
+
+async def resume_broadcasts(app):
+    rows = await db.run(_execute, "SELECT id FROM broadcasts WHERE status='running'")
+    for (bid,) in rows:
+        print("📣 Resuming broadcast", bid)
+        app.create_task(run_broadcast(app.bot, bid))
+
 # ================= ADMIN COMMANDS =================
 
 async def admin_menu(update, ctx):
@@ -486,12 +2788,61 @@ async def admin_menu(update, ctx):
         "/all_send <msg/photo/video>\n"
         "/user_send <id> <msg/photo/video>\n"
         "/update\n"
-        "/updateoff\n",
+        "/updateoff\n"
+        "/stats\n"
+        "/profile <seconds>\n",
 
         parse_mode="Markdown"
     )
 
 
+async def stats_cmd(update, ctx):
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text(
+        OPENROUTER_POOL.stats_text() + "\n\n" + ELEVEN_POOL.stats_text()
+        + "\n\n" + history_cache.stats_text()
+        + "\n" + IO_POOL.stats_text() + "\n" + CPU_POOL.stats_text()
+        + f"\n📺 YouTube cache: {len(yt_cache.data)} queries, hit {yt_cache.hit_rate():.1f}%, "
+        f"coalesced {yt_flight.coalesced}"
+        + "\n" + serp_stats_text()
+        + "\n" + tts_stats_text()
+        + "\n" + image_stats_text()
+        + "\n" + media_queue.stats_text()
+        + "\n" + update_processor.stats_text()
+        + "\n" + context_stats_text()
+        + "\n" + response_cache.stats_text()
+        + "\n" + admission_stats_text()
+        + "\n" + trace_stats_text()
+    )
+
+
+async def profile_cmd(update, ctx):
+    if not is_admin(update.effective_user.id):
+        return
+    try:
+        seconds = float(ctx.args[0]) if ctx.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+    seconds = max(1, min(PROFILE_MAX_SECONDS, seconds))
+    if profiler.running:
+        await update.message.reply_text("🔬 Profiler already chal raha hai, thoda wait karo")
+        return
+
+    await update.message.reply_text(f"🔬 Profiling {seconds:g}s...")
+
+    async def run():
+        try:
+            report = await profiler.run(seconds)
+        except ProfilerBusy:
+            report = "🔬 Profiler already chal raha hai, thoda wait karo"
+        await update.message.reply_text(report[:TG_MAX_LEN])
+
+    # in the background, so this admin's other updates aren't held up meanwhile
+    ctx.application.create_task(run())
+
+
 async def ban_user(update, ctx):
     if not is_admin(update.effective_user.id):
         return
@@ -500,11 +2851,13 @@ async def ban_user(update, ctx):
         return
 
     uid = ctx.args[0]
-    cur.execute(
+    db.write(
+        _execute,
         "INSERT OR REPLACE INTO bans(user_id,reason,ts) VALUES(?,?,?)",
         (uid, "Admin ban", int(time.time()))
     )
-    conn.commit()
+    BANNED.add(uid)
+    invalidate_user_state(uid)
 
     await update.message.reply_text(f"🚫 User {uid} banned successfully")
 
@@ -517,8 +2870,9 @@ async def unban_user(update, ctx):
         return
 
     uid = ctx.args[0]
-    cur.execute("DELETE FROM bans WHERE user_id=?", (uid,))
-    conn.commit()
+    db.write(_execute, "DELETE FROM bans WHERE user_id=?", (uid,))
+    BANNED.discard(uid)
+    invalidate_user_state(uid)
 
     await update.message.reply_text(f"❤️ User {uid} unbanned – ab free ho")
 
@@ -534,32 +2888,16 @@ async def all_send(update, ctx):
     parts = msg.text.split(" ", 1)
     broadcast_text = parts[1] if len(parts) > 1 else None
 
-    cur.execute("SELECT DISTINCT user_id FROM memory")
-    users = [u[0] for u in cur.fetchall()]
-
-    for uid in users:
-        try:
-            if reply:
-                if reply.photo:
-                    await ctx.bot.send_photo(uid, reply.photo[-1].file_id, caption=reply.caption)
-                elif reply.video:
-                    await ctx.bot.send_video(uid, reply.video.file_id, caption=reply.caption)
-                elif reply.audio:
-                    await ctx.bot.send_audio(uid, reply.audio.file_id, caption=reply.caption)
-                elif reply.document:
-                    await ctx.bot.send_document(uid, reply.document.file_id, caption=reply.caption)
-                elif reply.text:
-                    await ctx.bot.send_message(uid, reply.text)
-
-            elif broadcast_text:
-                await ctx.bot.send_message(uid, broadcast_text)
+    if not reply and not broadcast_text:
+        await msg.reply_text("Usage: /all_send <msg> (ya kisi message ko reply karke /all_send)")
+        return
 
-            await asyncio.sleep(1)
+    if reply:
+        bid = await db.run(_insert_broadcast, msg.chat_id, None, reply.chat_id, reply.message_id)
+    else:
+        bid = await db.run(_insert_broadcast, msg.chat_id, broadcast_text, None, None)
 
-        except Exception as e:
-            print("Broadcast error:", e)
-
-    await msg.reply_text("✅ Broadcast done")
+    ctx.application.create_task(run_broadcast(ctx.bot, bid))
 
 
 async def user_send(update, ctx):
@@ -643,34 +2981,48 @@ async def handle_text(update, ctx):
         )
         return
 
+    # 🚦 Rate limit
+    if not await admit(update, "chat"):
+        return
+
     # 3️⃣ User text save
     text = update.message.text
     save_msg(uid, "user", text)
-    await safe_action(ctx.bot, update.effective_chat.id)
+    ctx.application.create_task(safe_action(ctx.bot, update.effective_chat.id))
 
-    # 4️⃣ Context collection
-    yt_ctx = ""
-    web_ctx = ""
+    # 4️⃣ Context collection (concurrent, deadline-bound)
+    providers = {}
 
     if any(k in text.lower() for k in ["youtube", "video", "youtub", "youtube link", "youtub link", "youtuber" ]):
-        yt_ctx = search_youtube(text)
+        providers["yt"] = (search_youtube(text), YT_CONTEXT_TIMEOUT)
 
     if any(k in text.lower() for k in ["latest", "news", "price", "what is", "who is", "define", "search", "gold price", "dimond price", "bitcoin price"]):
-        web_ctx = await search_web_serp(text)
-
-    # 5️⃣ Compose messages
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages += load_memory(uid)
+        providers["web"] = (search_web_serp(text), SERP_CONTEXT_TIMEOUT)
+
+    cacheable = RESPONSE_CACHE and not providers and is_context_free(text)
+    if cacheable:
+        # a shared reply only fits a fresh conversation (history is just
+        # this message); mid-conversation even "hi" may mean something else
+        (history, summary), found = await load_context(uid), {}
+        cacheable = len(history) <= 1 and not summary
+        cached = response_cache.get(text) if cacheable else None
+        if cached:
+            save_msg(uid, "assistant", cached)
+            await send_reply(update, cached)
+            return
+    else:
+        (history, summary), found = await asyncio.gather(
+            load_context(uid), gather_context(providers)
+        )
+    extras = [found[k] for k in ("yt", "web") if found.get(k)]
 
-    if yt_ctx:
-        messages.append({"role": "system", "content": yt_ctx})
-    if web_ctx:
-        messages.append({"role": "system", "content": web_ctx})
+    # 5️⃣ Compose messages (token budget)
+    messages = fit_context(history, summary, extras, uid=uid)
 
     # 6️⃣ Ask AI
-    reply = await ask_openrouter(messages)
-    save_msg(uid, "assistant", reply)
-    await send_reply(update, reply)
+    reply = await answer(update, messages)
+    if cacheable and reply != AI_LIMITS_MSG:
+        response_cache.set(text, reply)
 
 
 # -------- VOICE HANDLER --------
@@ -691,17 +3043,19 @@ async def handle_voice(update, ctx):
         )
         return
 
+    # 🚦 Rate limit
+    if not await admit(update, "voice"):
+        return
+
     # 3️⃣ Download & convert voice
     await safe_action(ctx.bot, update.effective_chat.id)
     file_bytes = await download_file(ctx.bot, update.message.voice.file_id)
-    text = voice_to_text(file_bytes)
+    text = await voice_to_text(file_bytes, update.message.voice.file_unique_id)
     save_msg(uid, "user", text)
 
     # 4️⃣ AI reply
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + load_memory(uid)
-    reply = await ask_openrouter(messages)
-    save_msg(uid, "assistant", reply)
-    await send_reply(update, reply)
+    messages = fit_context(*await load_context(uid), uid=uid)
+    await answer(update, messages)
 
 
 # -------- PHOTO HANDLER --------
@@ -722,19 +3076,48 @@ async def handle_photo(update, ctx):
         )
         return
 
-    # 3️⃣ Download photo
+    # 🚦 Rate limit
+    if not await admit(update, "photo"):
+        return
+
     await safe_action(ctx.bot, update.effective_chat.id)
-    file_bytes = await download_file(ctx.bot, update.message.photo[-1].file_id)
+    photo = pick_photo_size(update.message.photo)
+    user_caption = update.message.caption or ""
+
+    # 3️⃣ Seen this image before? → text-only reply
+    description = photo_descriptions.get(photo.file_unique_id)
+    if description is not None:
+        save_msg(uid, "user", f"[Image sent] {description} {user_caption}".strip())
+        messages = fit_context(*await load_context(uid), uid=uid)
+        await answer(update, messages)
+        return
+
+    # 4️⃣ Download (right-sized) photo
+    file_bytes = await download_file(ctx.bot, photo.file_id)
+    file_bytes = await prepare_photo(file_bytes, photo)
 
-    # 4️⃣ Convert image → text
-    caption = await image_to_text(file_bytes)
-    save_msg(uid, "user", f"[Image sent] {caption}")
+    # 5️⃣ One vision call: description + reply
+    history, summary = await load_context(uid)
+    messages = fit_context(history, summary, uid=uid) + [photo_message(file_bytes, user_caption)]
+
+    if STREAM_REPLIES:
+        tag = {}
+        reply = await stream_reply(
+            update, messages, strip_image_tag(ask_openrouter_stream(messages), tag)
+        )
+        description = tag.get("description", "")
+    else:
+        description, reply = split_image_reply(await ask_openrouter(messages))
 
-    # 5️⃣ AI reply
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + load_memory(uid)
-    reply = await ask_openrouter(messages)
+    if description:
+        photo_descriptions.set(photo.file_unique_id, description)
+    save_msg(uid, "user", f"[Image sent] {description} {user_caption}".strip())
     save_msg(uid, "assistant", reply)
-    await send_reply(update, reply)
+
+    if STREAM_REPLIES:
+        media_queue.submit(uid, send_media, update, reply)
+    else:
+        await send_reply(update, reply)
 
 
 # -------- IMAGE COMMAND HANDLER (/image) --------
@@ -760,20 +3143,40 @@ async def image_cmd(update, ctx):
         await update.message.reply_text("🖼️ Usage:\n/image cute anime girl")
         return
 
+    # 🚦 Rate limit
+    if not await admit(update, "image"):
+        return
+
     prompt = " ".join(ctx.args)
     await safe_action(ctx.bot, update.effective_chat.id, ChatAction.UPLOAD_PHOTO)
 
-    # 4️⃣ Generate image
-    img = await generate_image_pollinations(prompt)
+    caption = f"🖼️ Generated by Priya\n✨ Prompt: {prompt}"
+    key = image_cache_key(prompt)
+
+    # 4️⃣ Already uploaded once? → re-send by file_id
+    file_id = await image_file_ids.get(key)
+    if file_id:
+        try:
+            await update.message.reply_photo(photo=file_id, caption=caption)
+            image_file_ids.reused += 1
+            return
+        except BadRequest as e:
+            print("Cached image file_id rejected:", e)
+            image_file_ids.forget(key)
+
+    # 5️⃣ Generate image
+    img = await generate_image_cached(prompt)
     if not img:
         await update.message.reply_text("🥺 Image generate nahi ho payi")
         return
 
-    # 5️⃣ Send photo
-    await update.message.reply_photo(
-        photo=InputFile(img, "image.jpg"),
-        caption=f"🖼️ Generated by Priya\n✨ Prompt: {prompt}"
-    ) 
+    # 6️⃣ Send photo
+    msg = await update.message.reply_photo(
+        photo=InputFile(BytesIO(img), "image.jpg"),
+        caption=caption
+    )
+    if msg.photo:
+        image_file_ids.remember(key, msg.photo[-1].file_id)
 # ================== COMMANDS ==================
 async def start(update, ctx):
     await update.message.reply_text(
@@ -811,12 +3214,253 @@ async def off_rose(update, ctx):
     set_voice(uid, "gtts", "")
     await update.message.reply_text("🔕 Rose voice OFF")
 
-# ================== MAIN ==================
-def main():
-    # 🔥 Keep bot awake (Render + UptimeRobot)
-    threading.Thread(target=run_web).start()
+# ================== UPDATE DISPATCH ==================
+# Different users' updates are processed concurrently (up to
+# UPDATE_CONCURRENCY at once); one user's updates stay strictly in order
+# behind a per-user lock, which is dropped as soon as nobody is waiting on it.
+# PTB's own semaphore only bounds how many updates may be waiting
+# (UPDATE_PENDING_LIMIT); the real limit is taken after the user lock, so a
+# user with a backlog never holds global slots while waiting for their turn.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_PENDING_LIMIT = int(os.getenv("UPDATE_PENDING_LIMIT", "4096"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency, pending_limit):
+        super().__init__(pending_limit)
+        self.concurrency = concurrency
+        self.slots = None
+        self.locks = {}        # user/chat id -> [asyncio.Lock, users of it]
+        self.in_flight = 0
+        self.waiting = 0       # updates whose turn came, waiting for a slot
+        self.commands = set()  # registered command names, for metric labels
+
+    async def initialize(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        pass
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    def handler_name(self, update):
+        msg = update.effective_message if isinstance(update, Update) else None
+        if msg is None:
+            return "other"
+        if msg.text and msg.text.startswith("/"):
+            cmd = msg.text[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(msg.text) > 1 else ""
+            return cmd if cmd in self.commands else "unknown_command"
+        if msg.voice:
+            return "voice"
+        if msg.photo:
+            return "photo"
+        if msg.text:
+            return "text"
+        return "other"
+
+    async def do_process_update(self, update, coroutine):
+        name = self.handler_name(update)
+        UPDATES_TOTAL.inc(name)
+        category = ADMISSION_CATEGORIES.get(name)
+        if category and update.effective_user and await shed(update, category):
+            coroutine.close()
+            return
+        t0 = time.perf_counter()
+        try:
+            with trace("update", handler=name, uid=self.update_key(update)):
+                await self._dispatch(update, coroutine)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - t0, name)
+
+    async def _dispatch(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            with span("wait_user"):
+                await entry[0].acquire()
+            try:
+                await self._run(coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    async def _run(self, coroutine):
+        self.waiting += 1
+        try:
+            with span("wait_slot"):
+                await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    def stats_text(self):
+        return (
+            f"🧵 Updates: {self.in_flight}/{self.concurrency} running, "
+            f"{self.waiting} waiting, {len(self.locks)} active users"
+        )
+
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_PENDING_LIMIT)
+
+# ================== RUNTIME METRICS ==================
+# Scrape-time views of the counters the subsystems already keep for /stats.
+@collector
+def queue_metrics():
+    depth = "priya_queue_depth", "gauge", "Jobs waiting or running in a queue."
+    limit = "priya_queue_limit", "gauge", "Configured queue capacity."
+    rejected = "priya_queue_rejected_total", "counter", "Jobs refused because a queue was full."
+    return [
+        (*depth, {"queue": "io_pool"}, IO_POOL.pending),
+        (*depth, {"queue": "cpu_pool"}, CPU_POOL.pending),
+        (*depth, {"queue": "media"}, media_queue.pending),
+        (*depth, {"queue": "updates"}, update_processor.in_flight),
+        (*depth, {"queue": "db"}, db.jobs.qsize()),
+        (*depth, {"queue": "updates_waiting"}, update_processor.waiting),
+        (*depth, {"queue": "llm_waiting"}, llm_limiter.waiting),
+        (*limit, {"queue": "io_pool"}, IO_POOL.limit),
+        (*limit, {"queue": "cpu_pool"}, CPU_POOL.limit),
+        (*limit, {"queue": "media"}, media_queue.max_pending),
+        (*limit, {"queue": "updates"}, update_processor.concurrency),
+        (*rejected, {"queue": "io_pool"}, IO_POOL.rejected),
+        (*rejected, {"queue": "cpu_pool"}, CPU_POOL.rejected),
+        (*rejected, {"queue": "media"}, media_queue.dropped),
+        ("priya_pool_timeouts_total", "counter", "Pool tasks that timed out.",
+         {"pool": "io"}, IO_POOL.timeouts),
+        ("priya_pool_timeouts_total", "counter", "Pool tasks that timed out.",
+         {"pool": "cpu"}, CPU_POOL.timeouts),
+        ("priya_active_users", "gauge", "Users with an update in progress or waiting.",
+         {}, len(update_processor.locks)),
+        ("priya_db_commits_total", "counter", "SQLite group commits.", {}, db.commits),
+        ("priya_llm_inflight", "gauge", "LLM calls in flight.", {}, llm_limiter.inflight),
+        ("priya_llm_inflight_limit", "gauge", "LLM_MAX_INFLIGHT.", {}, llm_limiter.limit),
+    ]
+
+@collector
+def key_metrics():
+    rows = []
+    now = time.monotonic()
+    for pool in (OPENROUTER_POOL, ELEVEN_POOL):
+        rows.append(("priya_key_failovers_total", "counter",
+                     "Failed key attempts that moved on to another key.",
+                     {"pool": pool.name}, pool.failovers))
+    for pool in (OPENROUTER_POOL, ELEVEN_POOL):
+        for k in pool.keys:
+            rows.append(("priya_key_cooling_down", "gauge", "1 while a key is in cooldown.",
+                         {"pool": pool.name, "key": pool.labels[k]},
+                         int(pool.state[k]["cooldown_until"] > now)))
+    return rows
+
+@collector
+def cache_metrics():
+    caches = {
+        "history": (history_cache.hits, history_cache.misses),
+        "youtube": (yt_cache.hits, yt_cache.misses),
+        "serp": (serp_cache.hits + serp_stats["db_hits"] + serp_flight.coalesced,
+                 serp_stats["calls"]),
+        "tts_file_id": (tts_file_ids.reused, None),
+        "tts_disk": (tts_disk.hits, tts_disk.misses),
+        "image_file_id": (image_file_ids.reused, None),
+        "image_disk": (image_disk.hits, image_disk.misses) if image_disk else (None, None),
+        "response": (response_cache.exact_hits + response_cache.near_hits, response_cache.misses),
+        "photo_description": (photo_descriptions.hits, photo_descriptions.misses),
+        "transcript": (transcripts.hits, transcripts.misses),
+    }
+    rows = []
+    for name, (hits, _) in caches.items():
+        if hits is not None:
+            rows.append(("priya_cache_hits_total", "counter", "Cache hits.", {"cache": name}, hits))
+    for name, (_, misses) in caches.items():
+        if misses is not None:
+            rows.append(("priya_cache_misses_total", "counter", "Cache misses.", {"cache": name}, misses))
+    return rows
+
+# ================== LIFECYCLE ==================
+def open_storage():
+    """SQLite (schema, migrations), bans and the disk caches; idempotent."""
+    global db, tts_disk, image_disk
+    if db is not None:
+        return
+    db = Database(DB_PATH, DB_COMMIT_INTERVAL, before_commit=_prune_memory)
+    BANNED.update(r[0] for r in db.submit(_execute, "SELECT user_id FROM bans").result())
+    tts_disk = DiskLRU(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1024 * 1024)
+    if IMAGE_CACHE_MAX_MB:
+        image_disk = DiskLRU(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB * 1024 * 1024)
+
+async def on_startup(app):
+    await asyncio.to_thread(open_storage)
+    db.loop = asyncio.get_running_loop()
+    await open_http_clients()
+    IO_POOL.start()
+    CPU_POOL.start()
+    await resume_broadcasts(app)
+    if not WEBHOOK_URL:
+        # 🔥 Keep bot awake (Render + UptimeRobot) while polling
+        await start_web_server(app)
+
+async def on_shutdown(app):
+    await stop_web_server()
+    await flush_summaries()
+    await close_http_clients()
+    IO_POOL.shutdown()
+    CPU_POOL.shutdown()
+    await asyncio.to_thread(db.close)
+
+async def run_webhook(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await on_startup(app)
+        try:
+            await start_web_server(app, webhook=True)
+            await app.bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            await app.start()
+            await stop.wait()
+        finally:
+            if app.running:
+                await app.stop()
+            await on_shutdown(app)
+
+# ================== MAIN ==================
+def build_app():
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_BASE_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .request(TelegramRequest(connection_pool_size=256))
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("voice", voice_on))
     app.add_handler(CommandHandler("voiceoff", voice_off))
@@ -835,9 +3479,23 @@ def main():
     app.add_handler(CommandHandler("user_send", user_send))
     app.add_handler(CommandHandler("update", update_bot))
     app.add_handler(CommandHandler("updateoff", update_off))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
+    update_processor.commands = {
+        c for h in app.handlers[0] if isinstance(h, CommandHandler) for c in h.commands
+    }
+    return app
 
+def main():
+    if not OPENROUTER_KEYS:
+        print("❌ No OpenRouter API keys found!")
+        exit(1)
+    app = build_app()
     print("🚀 PRIYA AI (YT + SERP + ZIP + VOICE) LIVE")
-    app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py reads its config at import time and exits without these
+_tmp = tempfile.mkdtemp(prefix="priya-tests-")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ.setdefault("OPENROUTER_API_1", "test-key")
+os.environ["DB_PATH"] = os.path.join(_tmp, "bot.db")
+os.environ["TTS_CACHE_DIR"] = os.path.join(_tmp, "tts")
+os.environ["IMAGE_CACHE_DIR"] = os.path.join(_tmp, "images")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+main.open_storage()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.monotonic (as seen by main) with a manual clock."""
+    c = Clock()
+    monkeypatch.setattr(main.time, "monotonic", c)
+    return c
+
+
+def pytest_sessionfinish(session, exitstatus):
+    main.db.close()
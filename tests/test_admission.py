@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import PerUserUpdateProcessor, UserRateLimiter
+
+
+# -------- per-user rate limits --------
+def test_rate_limit_per_user_and_category(clock):
+    limiter = UserRateLimiter({"chat": (2, 60), "voice": (1, 60)}, 100)
+    assert limiter.take(1, "chat") == 0
+    assert limiter.take(1, "chat") == 0
+    assert limiter.take(1, "chat") == 30   # one token per 30s
+    assert limiter.take(2, "chat") == 0
+    assert limiter.take(1, "voice") == 0
+    clock.advance(30)
+    assert limiter.take(1, "chat") == 0
+
+
+def test_rate_limit_zero_burst_is_off(clock):
+    limiter = UserRateLimiter({"chat": (0, 60)}, 100)
+    assert all(limiter.take(1, "chat") == 0 for _ in range(100))
+
+
+def test_rate_limit_keeps_at_most_max_users_buckets(clock):
+    limiter = UserRateLimiter({"chat": (1, 60)}, 2)
+    for uid in (1, 2, 3):
+        limiter.take(uid, "chat")
+    assert list(limiter.buckets) == [(2, "chat"), (3, "chat")]
+
+
+# -------- load shedding --------
+class _Message:
+    voice = photo = None
+
+    def __init__(self, text):
+        self.text = text
+        self.sent = []
+
+    async def reply_text(self, text):
+        self.sent.append(text)
+
+
+class _Update(main.Update):
+    def __init__(self, uid, text="hi"):
+        # telegram objects are frozen; these tests only need a few fields
+        object.__setattr__(self, "_msg", _Message(text))
+        object.__setattr__(self, "_user", SimpleNamespace(id=uid))
+
+    @property
+    def effective_message(self):
+        return self._msg
+
+    @property
+    def effective_user(self):
+        return self._user
+
+    @property
+    def effective_chat(self):
+        return None
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    p = PerUserUpdateProcessor(4, 100)
+    monkeypatch.setattr(main, "update_processor", p)
+    monkeypatch.setattr(main, "_admission_notified", main.TTLCache(100, 10))
+    return p
+
+
+def process(p, update):
+    ran = []
+
+    async def handler():
+        ran.append(update)
+
+    async def run():
+        await p.initialize()
+        await p.do_process_update(update, handler())
+
+    asyncio.run(run())
+    return bool(ran)
+
+
+def test_overload_sheds_before_the_handler(processor, monkeypatch):
+    monkeypatch.setattr(main.llm_limiter, "waiting", main.llm_shed_limit())
+    update = _Update(5)
+    assert not process(processor, update)
+    assert update.effective_message.sent == [main.BUSY_MSG]
+
+
+def test_no_shedding_below_the_limits(processor, monkeypatch):
+    monkeypatch.setattr(main.llm_limiter, "waiting", main.llm_shed_limit() - 1)
+    update = _Update(5)
+    assert process(processor, update)
+    assert update.effective_message.sent == []
+
+
+def test_admins_and_other_handlers_are_never_shed(processor, monkeypatch):
+    monkeypatch.setattr(main.llm_limiter, "waiting", main.llm_shed_limit())
+    assert process(processor, _Update(main.ADMIN_IDS[0]))
+    assert process(processor, _Update(5, "/start"))   # not a paid handler
+
+
+def test_llm_shed_limit_derives_from_the_concurrency_limits(monkeypatch):
+    monkeypatch.setattr(main, "SHED_LLM_WAITING", 0)
+    monkeypatch.setattr(main, "update_processor", PerUserUpdateProcessor(64, 100))
+    monkeypatch.setattr(main, "llm_limiter", main.LLMLimiter(32))
+    assert main.llm_shed_limit() == 16
+    monkeypatch.setattr(main, "SHED_LLM_WAITING", 5)
+    assert main.llm_shed_limit() == 5
@@ -0,0 +1,40 @@
+import asyncio
+
+from main import TokenBucket
+
+
+def test_token_bucket_burst_then_empty(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    assert [bucket.try_take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_refills_at_rate_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.try_take()
+    clock.advance(0.5)
+    assert bucket.try_take()
+    assert not bucket.try_take()
+    clock.advance(100)
+    assert [bucket.try_take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_pause_blocks_and_empties(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.pause(5)
+    clock.advance(4.9)
+    assert not bucket.try_take()
+    clock.advance(0.2)
+    assert bucket.try_take()   # refilled since the pause emptied it
+    assert bucket.tokens < 1
+
+
+def test_token_bucket_take_waits_for_a_token():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=1)
+        await bucket.take()
+        t0 = asyncio.get_running_loop().time()
+        await bucket.take()
+        return asyncio.get_running_loop().time() - t0
+
+    assert 0.005 <= asyncio.run(run()) < 0.5
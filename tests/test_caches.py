@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+from main import ResponseCache
+
+
+def jaccard(cache, a, b):
+    sa = cache._shingles(main.normalize_prompt(a))
+    sb = cache._shingles(main.normalize_prompt(b))
+    return len(sa & sb) / len(sa | sb)
+
+
+# one row per band: every shingle overlap makes a candidate, so these tests
+# exercise the similarity threshold rather than LSH recall
+def exact_cache(threshold, ttl=60):
+    return ResponseCache(100, ttl, threshold, num_perm=32, bands=32)
+
+
+def test_response_exact_hit_ignores_case_and_punctuation():
+    cache = exact_cache(0.8)
+    cache.set("Who are you?", "I'm Priya")
+    assert cache.get("who ARE you") == "I'm Priya"
+    assert (cache.exact_hits, cache.near_hits, cache.misses) == (1, 0, 0)
+
+
+def test_response_near_duplicate_hits_at_threshold():
+    a, b = "what is your name", "what is your name bestie"
+    cache = exact_cache(jaccard(exact_cache(0), a, b))
+    cache.set(a, "Priya")
+    assert cache.get(b) == "Priya"
+    assert cache.near_hits == 1
+
+
+def test_response_near_duplicate_misses_above_threshold():
+    a, b = "what is your name", "what is your name bestie"
+    cache = exact_cache(jaccard(exact_cache(0), a, b) + 1e-9)
+    cache.set(a, "Priya")
+    assert cache.get(b) is None
+    assert cache.misses == 1
+
+
+def test_response_near_duplicate_ignores_filler_and_word_order():
+    a, b = "tell me a joke please", "please tell me a joke bestie"
+    cache = exact_cache(jaccard(exact_cache(0), a, b))
+    cache.set(a, "Knock knock")
+    assert cache.get(b) == "Knock knock"
+
+
+def test_response_near_duplicate_needs_same_content_words():
+    pairs = [
+        ("write python code to check whether a number is prime",
+         "write python code to check whether a number is even"),
+        ("how to reverse a list in python", "how to reverse a string in python"),
+        ("difference between list and tuple", "difference between list and set"),
+        ("convert 1500 us dollars to rupees", "convert 2500 us dollars to rupees"),
+    ]
+    for a, b in pairs:
+        # at the measured similarity the shingles alone would call it a hit
+        cache = exact_cache(min(jaccard(exact_cache(0), a, b), 0.8))
+        cache.set(a, "cached")
+        assert cache.get(b) is None, b
+
+
+def test_response_unrelated_prompt_misses():
+    cache = ResponseCache(100, 60, 0.8)
+    cache.set("good morning", "Good morning bestie")
+    assert cache.get("explain recursion in python") is None
+
+
+def test_response_entries_expire(clock):
+    cache = exact_cache(0.5, ttl=60)
+    cache.set("hello there", "Hi!")
+    clock.advance(59)
+    assert cache.get("hello there") == "Hi!"
+    assert cache.get("hello there bestie") == "Hi!"
+    clock.advance(2)
+    assert cache.get("hello there") is None
+    assert cache.get("hello there bestie") is None
+
+
+def test_response_set_refreshes_expiry(clock):
+    cache = exact_cache(0.8, ttl=60)
+    cache.set("hello", "old")
+    clock.advance(50)
+    cache.set("hello", "new")
+    clock.advance(50)
+    assert cache.get("hello") == "new"
+
+
+def test_response_evicts_oldest_and_cleans_buckets():
+    cache = ResponseCache(2, 60, 0.8)
+    cache.set("first prompt", "1")
+    cache.set("second prompt", "2")
+    cache.set("third prompt", "3")
+    assert list(cache.entries) == ["second prompt", "third prompt"]
+    assert all("first prompt" not in b for b in cache.buckets.values())
+    assert cache.get("first prompt") is None
+
+
+def test_is_context_free():
+    assert main.is_context_free("Who are you?")
+    assert main.is_context_free("tell me a joke")
+    assert main.is_context_free("why is the sky blue")
+    assert not main.is_context_free("explain this again")
+    assert not main.is_context_free("")
+    assert not main.is_context_free("x " * 100)
+
+
+def test_is_context_free_rejects_bare_replies():
+    for text in ("yes", "no", "why?", "ok", "2", "haan", "kyun", "aur batao",
+                 "explain in hindi", "option 3"):
+        assert not main.is_context_free(text), text
+
+
+class _Message:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Update:
+    def __init__(self, uid, text):
+        self.message = _Message(text)
+        self.effective_user = SimpleNamespace(id=uid)
+        self.effective_chat = SimpleNamespace(id=uid)
+
+
+def chat(monkeypatch, text, history, summary=""):
+    """Runs handle_text with the DB, Telegram and the LLM stubbed out;
+    returns what the user was sent and whether the LLM was asked."""
+    sent, asked = [], []
+
+    async def load_context(uid):
+        return list(history), summary
+
+    async def answer(update, messages):
+        asked.append(messages)
+        return "fresh reply"
+
+    async def send_reply(update, reply):
+        sent.append(reply)
+
+    async def admit(update, category):
+        return True
+
+    monkeypatch.setattr(main, "load_context", load_context)
+    monkeypatch.setattr(main, "answer", answer)
+    monkeypatch.setattr(main, "send_reply", send_reply)
+    monkeypatch.setattr(main, "admit", admit)
+    monkeypatch.setattr(main, "save_msg", lambda *a: None)
+    ctx = SimpleNamespace(application=SimpleNamespace(create_task=lambda c: c.close()), bot=None)
+    asyncio.run(main.handle_text(_Update(5, text), ctx))
+    return sent, bool(asked)
+
+
+def test_cached_reply_only_for_a_fresh_conversation(monkeypatch):
+    cache = exact_cache(0.8)
+    cache.set("who are you", "I'm Priya")
+    monkeypatch.setattr(main, "response_cache", cache)
+    monkeypatch.setattr(main, "RESPONSE_CACHE", True)
+    first = [{"role": "user", "content": "who are you"}]
+
+    assert chat(monkeypatch, "who are you", first) == (["I'm Priya"], False)
+
+    earlier = [{"role": "user", "content": "hey"}, {"role": "assistant", "content": "hi!"}]
+    assert chat(monkeypatch, "who are you", earlier + first)[1]
+    assert chat(monkeypatch, "who are you", first, summary="they asked before")[1]
+
+
+def test_reply_stored_only_for_a_fresh_conversation(monkeypatch):
+    cache = exact_cache(0.8)
+    monkeypatch.setattr(main, "response_cache", cache)
+    monkeypatch.setattr(main, "RESPONSE_CACHE", True)
+    earlier = [{"role": "user", "content": "hey"}, {"role": "assistant", "content": "hi!"}]
+    chat(monkeypatch, "tell me a joke", earlier + [{"role": "user", "content": "tell me a joke"}])
+    assert not cache.entries
+    chat(monkeypatch, "tell me a joke", [{"role": "user", "content": "tell me a joke"}])
+    assert cache.get("tell me a joke") == "fresh reply"
@@ -0,0 +1,87 @@
+import asyncio
+
+import main
+
+
+def turn(role, words):
+    return {"role": role, "content": " ".join(f"w{i}" for i in range(words))}
+
+
+def test_fit_context_keeps_everything_within_budget():
+    history = [turn("user", 5), turn("assistant", 5)]
+    messages = main.fit_context(history, "")
+    assert messages[0] == {"role": "system", "content": main.SYSTEM_PROMPT}
+    assert messages[1:] == history
+
+
+def test_fit_context_drops_oldest_turns_first(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", main.count_tokens(main.SYSTEM_PROMPT) + 250)
+    history = [turn("user", 200), turn("assistant", 50), turn("user", 50)]
+    messages = main.fit_context(history, "")
+    assert messages[1:] == history[1:]
+
+
+def test_fit_context_summary_and_extras_take_budget(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", main.count_tokens(main.SYSTEM_PROMPT) + 250)
+    history = [turn("user", 50), turn("assistant", 50)]
+    extra = "search result " * 60
+    messages = main.fit_context(history, "they like cricket", extras=[extra])
+    assert messages[1]["content"].endswith("they like cricket")
+    assert messages[2:] == [history[-1], {"role": "system", "content": extra}]
+
+
+def test_fit_context_trims_an_oversized_newest_turn(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", main.count_tokens(main.SYSTEM_PROMPT) + 100)
+    big = {"role": "user", "content": "x" * 10000}
+    messages = main.fit_context([turn("user", 5), big], "")
+    assert len(messages) == 2
+    assert 0 < len(messages[1]["content"]) < len(big["content"])
+    assert big["content"].endswith(messages[1]["content"])
+
+
+def test_fit_context_queues_dropped_turns_for_summary(monkeypatch):
+    queued = []
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", main.count_tokens(main.SYSTEM_PROMPT) + 100)
+    monkeypatch.setattr(main, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(main, "schedule_summary", lambda uid, turns: queued.append((uid, turns)))
+    old, new = turn("user", 200), turn("assistant", 20)
+    main.fit_context([old, new], "", uid=7)
+    assert queued == [(7, [(old["role"], old["content"])])]
+
+
+def summary_batches(monkeypatch, min_turns=3, idle=60):
+    batches = []
+
+    async def update_summary(uid, turns, prev):
+        batches.append((uid, turns))
+
+    monkeypatch.setattr(main, "_update_summary", update_summary)
+    monkeypatch.setattr(main, "SUMMARY_MIN_TURNS", min_turns)
+    monkeypatch.setattr(main, "SUMMARY_IDLE_SECONDS", idle)
+    return batches
+
+
+def test_summary_batches_turns_until_the_threshold(monkeypatch):
+    batches = summary_batches(monkeypatch)
+
+    async def run():
+        main.schedule_summary(101, [("user", "a"), ("assistant", "b")])
+        await asyncio.sleep(0)
+        assert batches == []
+        # already queued turns (pruned after fit_context dropped them) don't count
+        main.schedule_summary(101, [("assistant", "b"), ("user", "c")])
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert batches == [("101", [("user", "a"), ("assistant", "b"), ("user", "c")])]
+
+
+def test_summary_flushes_when_idle(monkeypatch):
+    batches = summary_batches(monkeypatch, idle=0.01)
+
+    async def run():
+        main.schedule_summary(102, [("user", "only one")])
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert batches == [("102", [("user", "only one")])]
@@ -0,0 +1,74 @@
+from main import HistoryCache
+
+
+def msg(i):
+    return {"role": "user", "content": f"m{i}"}
+
+
+def test_history_load_keeps_messages_saved_meanwhile():
+    cache = HistoryCache(10, 60, 5)
+    cache.begin_load("u")
+    cache.append("u", msg(3))
+    rows = cache.finish_load("u", [msg(1), msg(2)])
+    assert rows == [msg(1), msg(2), msg(3)]
+    assert cache.get("u") == rows
+
+
+def test_history_keeps_last_turns_only():
+    cache = HistoryCache(10, 60, 3)
+    cache.begin_load("u")
+    cache.finish_load("u", [msg(i) for i in range(3)])
+    cache.append("u", msg(3))
+    assert cache.get("u") == [msg(1), msg(2), msg(3)]
+    assert cache.bytes == sum(HistoryCache._size(m) for m in cache.get("u"))
+
+
+def test_history_append_without_load_is_ignored():
+    cache = HistoryCache(10, 60, 3)
+    cache.append("u", msg(1))
+    assert cache.get("u") is None
+
+
+def test_history_expires(clock):
+    cache = HistoryCache(10, 60, 3)
+    cache.begin_load("u")
+    cache.finish_load("u", [msg(1)])
+    clock.advance(61)
+    assert cache.get("u") is None
+    assert cache.bytes == 0
+
+
+def test_history_evicts_least_recently_used():
+    cache = HistoryCache(2, 60, 3)
+    for uid in ("a", "b"):
+        cache.begin_load(uid)
+        cache.finish_load(uid, [msg(1)])
+    cache.get("a")
+    cache.begin_load("c")
+    cache.finish_load("c", [msg(1)])
+    assert set(cache.users) == {"a", "c"}
+
+
+def big(n):
+    return {"role": "assistant", "content": "x" * n}
+
+
+def test_history_evicts_to_the_byte_cap_on_load():
+    cache = HistoryCache(10, 60, 5, max_bytes=1000)
+    for uid in ("a", "b", "c"):
+        cache.begin_load(uid)
+        cache.finish_load(uid, [big(300)])
+    assert list(cache.users) == ["b", "c"]
+    assert cache.bytes <= 1000
+
+
+def test_history_evicts_to_the_byte_cap_on_append():
+    cache = HistoryCache(10, 60, 5, max_bytes=1000)
+    for uid in ("a", "b"):
+        cache.begin_load(uid)
+        cache.finish_load(uid, [big(100)])
+    cache.get("a")                    # b is now least recently used
+    cache.append("a", big(700))
+    assert list(cache.users) == ["a"]
+    assert cache.bytes == sum(HistoryCache._size(m) for m in cache.get("a"))
+    assert cache.evictions == 1
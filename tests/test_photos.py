@@ -0,0 +1,40 @@
+import asyncio
+
+import main
+
+
+async def _deltas(parts):
+    for p in parts:
+        yield p
+
+
+def strip(parts):
+    out = {}
+
+    async def run():
+        return "".join([d async for d in main.strip_image_tag(_deltas(parts), out)])
+
+    return asyncio.run(run()), out
+
+
+def test_strip_image_tag_split_across_deltas():
+    text, out = strip(["[Ima", "ge: a cat on", " a sofa] Aww", " cute!"])
+    assert text == "Aww cute!"
+    assert out == {"description": "a cat on a sofa"}
+
+
+def test_strip_image_tag_passes_untagged_reply_through():
+    text, out = strip(["Hel", "lo ", "bestie"])
+    assert text == "Hello bestie"
+    assert out == {}
+
+
+def test_strip_image_tag_unterminated_tag_is_not_lost():
+    text, out = strip(["[Image: never", " closed"])
+    assert text == "[Image: never closed"
+    assert out == {}
+
+
+def test_split_image_reply():
+    assert main.split_image_reply("[Image: a dog]\nNice dog!") == ("a dog", "Nice dog!")
+    assert main.split_image_reply("No tag here") == ("", "No tag here")
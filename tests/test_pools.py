@@ -0,0 +1,60 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+from main import PoolBusy, TaskPool
+
+
+def thread_pool(limit, workers=1):
+    return TaskPool(
+        "test", lambda: concurrent.futures.ThreadPoolExecutor(workers), limit
+    )
+
+
+def test_timed_out_task_keeps_its_slot_until_it_ends():
+    pool = thread_pool(limit=1)
+    gate = threading.Event()
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(gate.wait, timeout=0.05)
+        assert pool.timeouts == 1
+        # the thread is still stuck in gate.wait(): no room for another task
+        assert pool.pending == 1
+        with pytest.raises(PoolBusy):
+            await pool.run(lambda: "late")
+
+        gate.set()
+        for _ in range(100):
+            if not pool.pending:
+                break
+            await asyncio.sleep(0.01)
+        assert pool.pending == 0
+        return await pool.run(lambda: "ok", timeout=1)
+
+    try:
+        assert asyncio.run(run()) == "ok"
+    finally:
+        gate.set()
+        pool.shutdown()
+
+
+def test_slot_released_after_success_and_error():
+    pool = thread_pool(limit=2, workers=2)
+
+    def boom():
+        raise ValueError("boom")
+
+    async def run():
+        assert await pool.run(sum, [1, 2], timeout=1) == 3
+        with pytest.raises(ValueError):
+            await pool.run(boom, timeout=1)
+        await asyncio.sleep(0.01)   # release is scheduled from the worker
+        return pool.pending
+
+    try:
+        assert asyncio.run(run()) == 0
+    finally:
+        pool.shutdown()
@@ -0,0 +1,183 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+import main
+from main import KeyPool
+
+
+# -------- key in-flight accounting when a call is abandoned --------
+def sse(*deltas):
+    async def body():
+        for d in deltas:
+            yield f"data: {json.dumps({'choices': [{'delta': {'content': d}}]})}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+    return body()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """OpenRouter stand-in; set `upstream.hang` to make requests never answer."""
+    state = type("Upstream", (), {"hang": False, "requests": 0})()
+
+    async def handler(request):
+        state.requests += 1
+        if state.hang:
+            await asyncio.Event().wait()
+        if json.loads(request.content).get("stream"):
+            return httpx.Response(200, content=sse("Hello", " there"))
+        return httpx.Response(200, json={"choices": [{"message": {"content": "Hello"}}]})
+
+    pool = KeyPool("test", ["key-1", "key-2"])
+    monkeypatch.setattr(main, "OPENROUTER_POOL", pool)
+    monkeypatch.setattr(main, "llm_limiter", main.LLMLimiter(4))
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "http_client", lambda name: client)
+    state.pool = pool
+    return state
+
+
+def inflight(pool):
+    return {k: st["inflight"] for k, st in pool.state.items()}
+
+
+async def started(upstream):
+    while not upstream.requests:
+        await asyncio.sleep(0.001)
+
+
+async def collect(agen):
+    return [d async for d in agen]
+
+
+def test_completed_calls_leave_nothing_in_flight(upstream):
+    assert asyncio.run(main.ask_openrouter([])) == "Hello"
+    assert asyncio.run(collect(main.ask_openrouter_stream([]))) == ["Hello", " there"]
+    assert inflight(upstream.pool) == {"key-1": 0, "key-2": 0}
+
+
+@pytest.mark.parametrize("call", [
+    lambda: main.ask_openrouter([]),
+    lambda: collect(main.ask_openrouter_stream([])),
+])
+def test_cancelled_call_releases_the_key(upstream, call):
+    upstream.hang = True
+
+    async def run():
+        task = asyncio.ensure_future(call())
+        await started(upstream)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert inflight(upstream.pool) == {"key-1": 0, "key-2": 0}
+    # cancelling is not the key's fault
+    assert all(st["errors"] == 0 for st in upstream.pool.state.values())
+
+
+def test_stream_closed_early_releases_the_key(upstream):
+    async def run():
+        agen = main.ask_openrouter_stream([])
+        first = await agen.__anext__()
+        await agen.aclose()
+        return first
+
+    assert asyncio.run(run()) == "Hello"
+    assert inflight(upstream.pool) == {"key-1": 0, "key-2": 0}
+
+
+# -------- best-effort message edits --------
+class _Sent:
+    def __init__(self, chat, text):
+        self.chat = chat
+        self.text = text
+
+    async def edit_text(self, text):
+        await self.chat.call("edit", text)
+        self.text = text
+
+
+class _Chat:
+    """Telegram stand-in: `fail` scripts the next calls (an exception to
+    raise, or None to succeed); later calls succeed."""
+
+    def __init__(self, fail=()):
+        self.fail = list(fail)
+        self.calls = []
+        self.sent = []
+
+    async def call(self, kind, text):
+        self.calls.append(kind)
+        error = self.fail.pop(0) if self.fail else None
+        if error is not None:
+            raise error
+
+    async def reply_text(self, text):
+        await self.call("send", text)
+        msg = _Sent(self, text)
+        self.sent.append(msg)
+        return msg
+
+
+class _Update:
+    def __init__(self, chat):
+        self.message = chat
+
+
+def stream(chat, deltas, clock, step=1.0):
+    """stream_reply over `deltas`, the clock moving `step` s per delta;
+    a delta that is an exception is raised by the stream instead."""
+    async def source():
+        for d in deltas:
+            clock.advance(step)
+            if isinstance(d, Exception):
+                raise d
+            yield d
+
+    return asyncio.run(main.stream_reply(_Update(chat), [], deltas=source()))
+
+
+def test_failed_first_send_backs_off_and_recovers(clock, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 1.5)
+    chat = _Chat(fail=[TimedOut()])
+    text = stream(chat, ["a", "b", "c", "d"], clock)
+    assert text == "abcd"
+    # a: send times out → no new attempt before the interval; c: sent again
+    assert chat.calls == ["send", "send", "edit"]
+    assert [m.text for m in chat.sent] == ["abcd"]
+
+
+def test_network_errors_on_edits_keep_the_reply(clock, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0)
+    chat = _Chat(fail=[None, NetworkError("reset"), NetworkError("reset")])
+    text = stream(chat, ["a", "b", "c", "d"], clock)
+    assert text == "abcd"
+    assert chat.calls == ["send", "edit", "edit", "edit"]
+    assert chat.sent[0].text == "abcd"
+
+
+def test_bad_request_on_edit_is_not_fatal(clock, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL", 0)
+    chat = _Chat(fail=[None, BadRequest("Message can't be edited")])
+    text = stream(chat, ["a", "b", "c"], clock)
+    assert text == "abc"
+    assert chat.calls == ["send", "edit", "edit"]
+    assert chat.sent[0].text == "abc"
+
+
+def test_stream_error_keeps_text_received_so_far(clock):
+    chat = _Chat()
+    text = stream(chat, ["Hello", " wor", RuntimeError("upstream died")], clock)
+    assert text == "Hello wor"
+    assert chat.sent[-1].text == "Hello wor"
+
+
+def test_stream_error_before_any_text_gives_the_fallback(clock):
+    chat = _Chat()
+    text = stream(chat, [RuntimeError("upstream died")], clock)
+    assert text == main.AI_LIMITS_MSG
+    assert chat.sent[-1].text == main.AI_LIMITS_MSG
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+from main import PerUserUpdateProcessor
+
+
+class _Update(main.Update):
+    def __init__(self, uid):
+        # telegram objects are frozen; the processor only needs the user
+        object.__setattr__(self, "_user", SimpleNamespace(id=uid))
+
+    @property
+    def effective_user(self):
+        return self._user
+
+    @property
+    def effective_message(self):
+        return None
+
+    @property
+    def effective_chat(self):
+        return None
+
+
+def run_updates(processor, jobs):
+    """Feeds (uid, name, seconds) jobs in order, as PTB does, and returns
+    the (event, name) log plus the peak number of handlers running."""
+    log, running, peak = [], [0], [0]
+
+    async def handler(name, seconds):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        log.append(("start", name))
+        await asyncio.sleep(seconds)
+        log.append(("end", name))
+        running[0] -= 1
+
+    async def run():
+        await processor.initialize()
+        await asyncio.gather(*[
+            processor.do_process_update(_Update(uid), handler(name, seconds))
+            for uid, name, seconds in jobs
+        ])
+
+    asyncio.run(run())
+    return log, peak[0]
+
+
+def test_one_users_updates_run_in_order():
+    p = PerUserUpdateProcessor(8, 100)
+    log, peak = run_updates(p, [(1, "a", 0.03), (1, "b", 0), (1, "c", 0.01)])
+    assert log == [("start", "a"), ("end", "a"), ("start", "b"), ("end", "b"),
+                   ("start", "c"), ("end", "c")]
+    assert peak == 1
+
+
+def test_different_users_run_concurrently():
+    p = PerUserUpdateProcessor(8, 100)
+    log, peak = run_updates(p, [(1, "a", 0.03), (2, "b", 0.01), (1, "c", 0)])
+    assert log.index(("end", "b")) < log.index(("end", "a"))   # b didn't wait for a
+    assert log.index(("end", "a")) < log.index(("start", "c"))
+    assert peak == 2
+
+
+def test_concurrency_limit_holds():
+    p = PerUserUpdateProcessor(2, 100)
+    _, peak = run_updates(p, [(uid, str(uid), 0.01) for uid in range(6)])
+    assert peak == 2
+
+
+def test_user_locks_are_dropped_when_idle():
+    p = PerUserUpdateProcessor(8, 100)
+    run_updates(p, [(1, "a", 0.01), (1, "b", 0), (2, "c", 0)])
+    assert p.locks == {}
+    assert (p.in_flight, p.waiting) == (0, 0)
+
+
+def test_lock_dropped_after_a_failing_handler():
+    p = PerUserUpdateProcessor(8, 100)
+
+    async def boom():
+        raise ValueError("boom")
+
+    async def run():
+        await p.initialize()
+        try:
+            await p.do_process_update(_Update(1), boom())
+        except ValueError:
+            pass
+
+    asyncio.run(run())
+    assert p.locks == {}
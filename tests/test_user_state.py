@@ -0,0 +1,37 @@
+import asyncio
+
+import main
+
+
+def test_invalidate_during_a_read_is_not_undone():
+    async def run():
+        read = asyncio.ensure_future(main.get_user_state(601))
+        await asyncio.sleep(0)              # the read is waiting on the DB
+        main.set_voice_mode(601, 1)         # write + invalidate meanwhile
+        stale = await read
+        fresh = await main.get_user_state(601)
+        return stale, fresh
+
+    stale, fresh = asyncio.run(run())
+    assert stale.voice_mode == 0
+    assert fresh.voice_mode == 1            # the stale row was not cached
+    assert main._user_state_reads == {}
+
+
+def test_read_without_invalidation_is_cached():
+    async def run():
+        first = await main.get_user_state(602)
+        return first, await main.get_user_state(602)
+
+    first, second = asyncio.run(run())
+    assert first is second
+
+
+def test_invalidate_after_write_shows_new_settings():
+    async def run():
+        await main.get_user_state(603)
+        main.set_voice(603, "eleven", "rose")
+        return await main.get_user_state(603)
+
+    st = asyncio.run(run())
+    assert (st.voice_engine, st.voice_name) == ("eleven", "rose")
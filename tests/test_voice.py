@@ -0,0 +1,81 @@
+import asyncio
+import concurrent.futures
+import subprocess
+import threading
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+RATE = 16000
+
+
+class RecordingTranscriber:
+    """Says which chunk it got: speech segment k is a tone of amplitude k * 1000."""
+
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def transcribe(self, wav_bytes):
+        with self.lock:
+            self.calls += 1
+        k = round(max(array("h", wav_bytes[44:])) / 1000)
+        if k in self.fail_on:
+            raise RuntimeError("recognizer failed")
+        return f"part{k}"
+
+
+_decode_and_split = main.workers.decode_and_split
+
+
+def split_short(data, max_chunk_s=30, **kw):
+    """1s segments are long enough to be their own chunks."""
+    return _decode_and_split(data, max_chunk_s, min_chunk_s=0.5, **kw)
+
+
+@pytest.fixture
+def voice(monkeypatch):
+    """voice_to_text with CPU work on threads and ffmpeg decoding to PCM of
+    three 1s speech segments separated by 1s of silence."""
+    speech = lambda k: array("h", [k * 1000, -k * 1000] * (RATE // 2))   # noqa: E731
+    silence = array("h", bytes(2 * RATE))
+    pcm = speech(1) + silence + speech(2) + silence + speech(3)
+    monkeypatch.setattr(subprocess, "run", lambda *a, **k: SimpleNamespace(stdout=pcm.tobytes()))
+    monkeypatch.setattr(main, "CPU_POOL", main.TaskPool(
+        "cpu", lambda: concurrent.futures.ThreadPoolExecutor(2), 10))
+    monkeypatch.setattr(main, "transcripts", main.TTLCache(10, 60))
+    monkeypatch.setattr(main, "transcriber", main.transcriber)   # restored afterwards
+    monkeypatch.setattr(main.workers, "decode_and_split", split_short)
+    yield
+    main.CPU_POOL.shutdown()
+
+
+def test_chunks_are_transcribed_and_joined_in_order(voice):
+    rec = RecordingTranscriber()
+    main.set_transcriber(rec)
+    text = asyncio.run(main.voice_to_text(b"ogg", "file-1"))
+    assert text == "part1 part2 part3"
+    assert rec.calls == 3
+
+
+def test_transcripts_are_cached_by_file_id(voice):
+    rec = RecordingTranscriber()
+    main.set_transcriber(rec)
+    asyncio.run(main.voice_to_text(b"ogg", "file-2"))
+    assert asyncio.run(main.voice_to_text(b"ogg", "file-2")) == "part1 part2 part3"
+    assert rec.calls == 3
+
+
+def test_a_failed_chunk_is_skipped(voice):
+    main.set_transcriber(RecordingTranscriber(fail_on={2}))
+    assert asyncio.run(main.voice_to_text(b"ogg")) == "part1 part3"
+
+
+def test_nothing_recognized_gives_the_fallback(voice):
+    main.set_transcriber(RecordingTranscriber(fail_on={1, 2, 3}))
+    assert asyncio.run(main.voice_to_text(b"ogg", "file-3")) == main.VOICE_FALLBACK
+    assert main.transcripts.get("file-3") is None
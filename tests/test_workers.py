@@ -0,0 +1,68 @@
+import io
+import math
+import subprocess
+import wave
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+from workers import decode_and_split
+
+RATE = 16000
+
+
+def tone(seconds, amplitude=8000):
+    n = int(seconds * RATE)
+    return array("h", (int(amplitude * math.sin(2 * math.pi * 440 * i / RATE)) for i in range(n)))
+
+
+def silence(seconds):
+    return array("h", bytes(2 * int(seconds * RATE)))
+
+
+def split(pcm, monkeypatch, **kw):
+    """decode_and_split with ffmpeg replaced by a decoder returning `pcm`."""
+    monkeypatch.setattr(subprocess, "run", lambda *a, **k: SimpleNamespace(stdout=pcm.tobytes()))
+    return decode_and_split(b"ogg", **kw)
+
+
+def duration(chunk):
+    with wave.open(io.BytesIO(chunk)) as w:
+        assert (w.getframerate(), w.getnchannels(), w.getsampwidth()) == (RATE, 1, 2)
+        return w.getnframes() / RATE
+
+
+def test_splits_on_silence(monkeypatch):
+    pcm = tone(2) + silence(1) + tone(2)
+    chunks = split(pcm, monkeypatch, min_chunk_s=1)
+    assert len(chunks) == 2
+    assert all(1.5 < duration(c) < 3.5 for c in chunks)
+
+
+def test_short_pauses_do_not_split(monkeypatch):
+    pcm = tone(2) + silence(0.1) + tone(2)
+    assert len(split(pcm, monkeypatch, min_chunk_s=1)) == 1
+
+
+def test_long_speech_is_cut_at_max_chunk(monkeypatch):
+    chunks = split(tone(7), monkeypatch, max_chunk_s=3, min_chunk_s=1)
+    assert len(chunks) == 3
+    assert all(duration(c) <= 3.01 for c in chunks)
+
+
+def test_silence_only_gives_no_chunks(monkeypatch):
+    assert split(silence(3), monkeypatch) == []
+
+
+def test_ffmpeg_gets_the_timeout(monkeypatch):
+    seen = {}
+
+    def run(*a, **k):
+        seen.update(k)
+        raise subprocess.TimeoutExpired(a[0], k["timeout"])
+
+    monkeypatch.setattr(subprocess, "run", run)
+    with pytest.raises(subprocess.TimeoutExpired):
+        decode_and_split(b"ogg", timeout=7)
+    assert seen["timeout"] == 7
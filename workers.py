@@ -0,0 +1,66 @@
+# ================== CPU WORKERS ==================
+# Functions run inside CPU_POOL worker processes. They live outside main.py
+# so they pickle by reference to this small module. A spawned worker still
+# re-runs the main script as __mp_main__ (imports only: main.py opens the DB
+# and disk caches at startup, not on import).
+from io import BytesIO
+
+
+def downscale_jpeg(data, max_side, quality=80):
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    img.thumbnail((max_side, max_side))
+    out = BytesIO()
+    img.convert("RGB").save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def decode_and_split(data, max_chunk_s=30, min_chunk_s=5, min_silence_s=0.4,
+                     silence_rms=400, rate=16000, timeout=None):
+    """Decodes any ffmpeg-readable audio (Telegram OGG/Opus) to 16 kHz mono
+    and splits it on silences into WAV chunks of at most `max_chunk_s`.
+    ffmpeg is killed after `timeout` seconds (subprocess.TimeoutExpired)."""
+    import subprocess
+    import wave
+    from array import array
+
+    proc = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-ac", "1", "-ar", str(rate), "-f", "s16le", "pipe:1"],
+        input=data, capture_output=True, check=True, timeout=timeout
+    )
+    pcm = array("h", proc.stdout)
+
+    frame = rate * 30 // 1000                 # 30 ms analysis frames
+    silent = []
+    for start in range(0, len(pcm), frame):
+        window = pcm[start:start + frame:4]   # every 4th sample is plenty here
+        energy = sum(s * s for s in window) / max(1, len(window))
+        silent.append(energy < silence_rms * silence_rms)
+
+    min_frames = int(min_chunk_s * 1000 / 30)
+    max_frames = int(max_chunk_s * 1000 / 30)
+    gap_frames = max(1, int(min_silence_s * 1000 / 30))
+
+    cuts = [0]
+    run = 0
+    for i, quiet in enumerate(silent):
+        run = run + 1 if quiet else 0
+        length = i - cuts[-1]
+        if (run >= gap_frames and length >= min_frames) or length >= max_frames:
+            cuts.append(i)
+            run = 0
+    cuts.append(len(silent))
+
+    chunks = []
+    for a, b in zip(cuts, cuts[1:]):
+        if b <= a or all(silent[a:b]):
+            continue
+        out = BytesIO()
+        with wave.open(out, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(pcm[a * frame:b * frame].tobytes())
+        chunks.append(out.getvalue())
+    return chunks